@@ -6,13 +6,771 @@
 #Authors of the ChangeAtZ plugin / script:
 # Written by Marcus Adams, rawlogic@gmail.com
 
-from ..Script import Script
+import collections
+import functools
+import hashlib
+import json
+import math
+import os
 import re
-from UM.Application import Application
+import time
+try:
+    from ..Script import Script
+    from UM.Application import Application
+    from UM.Resources import Resources
+except ImportError:
+    # Not running in Cura's PostProcessingPlugin, eg. from change_at_height_cli.py
+    # This stands in for the plugin's Script class: the settings are a plain dictionary that starts out with the default values
+    Application = None
+    Resources = None
+    class Script:
+        def __init__(self):
+            self.settings = {}
+            for key, setting in json.loads(self.getSettingDataString())["settings"].items():
+                value = setting["default_value"]
+                if setting["type"] == "float":
+                    value = float(value)
+                elif setting["type"] == "int":
+                    value = int(value)
+                self.settings[key] = value
+
+        def getSettingValueByKey(self, key):
+            return self.settings[key]
+try:
+    import sqlite3
+except ImportError:
+    # Without sqlite there is no layer cache, everything else works the same
+    sqlite3 = None
+
+# How many layer summaries the layer cache keeps. The least recently used ones go first
+LAYER_CACHE_SIZE = 200000
+# Change when what LayerSummary.toJson gives changes, so summaries of other versions of the script are dropped instead of read
+LAYER_CACHE_VERSION = 1
+
+# The numbers the original getValue accepted (see legacy_change_at_height.py), including values without a leading zero like ".3"
+NUMBER_PATTERN = r'-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)'
+NUMBER_RE = re.compile(NUMBER_PATTERN)
+# A parameter word in the code part of a line: a capital letter, optionally followed by a number, eg. "X100", "E-.3" or the "P" in "M117 Printing..."
+WORD_RE = re.compile(r'([A-Z])(' + NUMBER_PATTERN + ')?')
+
+# Whole layer patterns, used to summarize a layer without going through it line by line.
+# The first E value in the code part of every line, which is what tokenizeLine gives
+E_VALUE_RE = re.compile(r'^[^;\nE]*E(' + NUMBER_PATTERN + ')', re.M)
+# Every Z value, including ones that tokenizeLine would ignore. Z is rare, so this is a lot quicker, and the extra values only make the highest Z higher
+Z_VALUE_RE = re.compile(r'Z(' + NUMBER_PATTERN + ')')
+# Anything that looks like G90/G91/G92, M82/M83 or M104/M109. It also finds some that aren't (in a comment, or not the first G on the line), those lines get tokenized to check
+MODAL_RE = re.compile(r'[GM]0*(?:9[0-2]|8[23]|10[49])(?![0-9])')
+# A layer without any of these can't have a line that MODAL_RE finds, and checking for them is much quicker than running MODAL_RE over a layer with a G on every line
+MODAL_HINTS = ("G9", "G09", "G00", "M8", "M08", "M10", "M01", "M00")
+
+# A single line of g-code, parsed once.
+#   letter/number: the command word, eg. "G" and 1.0 for "G1 X10 Y10". None for comment only or empty lines.
+#   params: the first value of every letter in the code part of the line, eg. {"G": 1.0, "X": 10.0, "Y": 10.0}. A letter without a number maps to None.
+#   comment: everything from the first ";" on, eg. ";LAYER:5". Empty if there is no comment.
+class GcodeCommand:
+    __slots__ = ("letter", "number", "params", "comment")
+
+    def __init__(self, letter, number, params, comment):
+        self.letter = letter
+        self.number = number
+        self.params = params
+        self.comment = comment
+
+    #   Value of a marker comment like ";LAYER:" or ";LAYER_COUNT:", the same way the original getValue read it. None if the line isn't that marker.
+    def getMarker(self, marker):
+        if not self.comment.startswith(marker):
+            return None
+        m = NUMBER_RE.match(self.comment, len(marker))
+        if m is None:
+            return None
+        return float(m.group(0))
+
+#   Split a line of g-code into a GcodeCommand in a single pass.
+#   A letter only counts the first time it shows up, and anything in the comment is ignored, which matches what the original getValue returned for each key.
+def tokenizeLine(line):
+    semicolon = line.find(";")
+    if semicolon == -1:
+        code = line
+        comment = ""
+    else:
+        code = line[:semicolon]
+        comment = line[semicolon:]
+    params = {}
+    letter = None
+    number = None
+    if code:
+        for key, value in WORD_RE.findall(code):
+            if key not in params:
+                params[key] = float(value) if value else None
+                if letter is None:
+                    letter = key
+                    number = params[key]
+    return GcodeCommand(letter, number, params, comment)
+
+# One pause of the schedule. pause_type is 'height' (value in mm) or 'layer' (value is the layer number, first layer is 1)
+# temperature is what to heat the extruder back up to after cooling down, None for the last temperature set in the g-code
+class PauseRequest:
+    __slots__ = ("pause_type", "value", "method", "temperature")
+
+    def __init__(self, pause_type, value, method, temperature = None):
+        self.pause_type = pause_type
+        self.value = value
+        self.method = method
+        self.temperature = temperature
+
+    #   Should we pause in front of a move at this layer and height?
+    def isDue(self, current_layer, current_z):
+        if self.pause_type == 'height':
+            return current_z >= self.value
+        return current_layer >= self.value
+
+#   Read the pause schedule setting into a list of PauseRequests.
+#   Pauses are separated by commas. A plain number is a layer, a number followed by "mm" is a height, and ":m25", ":m0" or ":m600" picks the method for that pause.
+#   "@" and a temperature or material name at the end is what to heat back up to after cooling down, for the filament that goes in at that pause.
+#   Material names are looked up with get_temperature(name), see material_library.py.
+#   eg. "5, 12.5mm:m600, 20:m0@235" pauses at layer 5 with the default method, at 12.5mm with M600 and at layer 20 with M0, heating back up to 235.
+def parsePauseSchedule(schedule, default_method, get_temperature = None):
+    pauses = []
+    for entry in schedule.split(","):
+        entry = entry.strip().lower()
+        if not entry:
+            continue
+        method = default_method
+        temperature = None
+        if "@" in entry:
+            entry, material = [part.strip() for part in entry.split("@", 1)]
+            try:
+                temperature = float(material)
+            except ValueError:
+                if get_temperature is None:
+                    raise ValueError("Can't look up material '%s' in the pause schedule without a material library, use a temperature instead" % material)
+                temperature = get_temperature(material)
+        if ":" in entry:
+            entry, method = [part.strip() for part in entry.split(":", 1)]
+            if method not in ("m25", "m0", "m600"):
+                raise ValueError("Unknown pause method '%s' in the pause schedule" % method)
+        try:
+            if entry.endswith("mm"):
+                pauses.append(PauseRequest('height', float(entry[:-2]), method, temperature))
+            else:
+                pauses.append(PauseRequest('layer', int(entry), method, temperature))
+        except ValueError:
+            raise ValueError("Can't read '%s' in the pause schedule, use a layer number or a height like 12.5mm" % entry)
+    return pauses
+
+#   Put a layer back together with gcode inserted before some of its lines.
+#   insertions is a list of (line index, gcode) in line order. Each gcode goes right before the line at that index, the same way a single pause has always been added.
+#   Everything is joined in one go, so it doesn't matter how many insertions there are or how big the layer is.
+#   ending goes after the last line. The script has always added a newline there when it made a layer again
+def spliceLines(lines, insertions, ending = "\n"):
+    pieces = []
+    start = 0
+    for line_index, gcode in insertions:
+        if line_index == start and pieces:
+            # Several pauses before the same line go right after each other
+            pieces.append(gcode)
+            continue
+        pieces.append("\n".join(lines[start:line_index]))
+        pieces.append("\n")
+        pieces.append(gcode)
+        start = line_index
+    pieces.append("\n".join(lines[start:]))
+    pieces.append(ending)
+    return "".join(pieces)
+
+# Everything a pause block depends on apart from where it goes: the script settings and the size of the machine.
+# It's read once per run, and being a tuple it can be the key for the compiled templates.
+class PauseSettings(collections.namedtuple("PauseSettings", ("park_x", "park_y", "move_z", "min_head_park_z", "retraction_mm", "extrusion_mm", "prime_mm",
+                                                              "beep", "cool_down", "change_filament", "machine_width", "machine_depth", "machine_height"))):
+    __slots__ = ()
+
+    #   The height to park the head at when pausing at current_z
+    def getNewZ(self, current_z):
+        # Move nozzle away from the bed so they can get their fingers under the nozzle
+        # Don't allow negative moveZ value. That would be bad. They would hit their print.
+        move_z = max(self.move_z, 0)
+        # Always move up to at least min z park value
+        if current_z + move_z < self.min_head_park_z:
+            return self.min_head_park_z
+        # We're getting the Max Z value from their print settings to make sure we don't go higher than their printer allows
+        # For Safety Leave a 10mm space (endstop)
+        max_z = self.machine_height - 10
+        new_z = current_z + move_z
+        if new_z > max_z:
+            new_z = max_z
+        return new_z
+
+# Where the layers of a print are, from the layer height settings it was sliced with: the Z of every raft layer, then the Z of the first layer of the model and the height of the ones above it.
+# Layer numbers count every ;LAYER:, raft layers included, the same way the pauses count them.
+class LayerHeights(collections.namedtuple("LayerHeights", ("raft_z", "first_layer_z", "layer_height"))):
+    __slots__ = ()
+
+    #   The Z of a layer (first layer is 1) as it's written in the g-code, to the micrometer
+    def getLayerZ(self, layer):
+        if layer <= len(self.raft_z):
+            return round(self.raft_z[layer - 1], 3)
+        return round(self.first_layer_z + (layer - len(self.raft_z) - 1) * self.layer_height, 3)
+
+    #   The first layer that gets to the height, which is where a pause at that height goes
+    def getLayerNumber(self, height):
+        for layer in range(1, len(self.raft_z) + 1):
+            if self.getLayerZ(layer) >= height:
+                return layer
+        layer = len(self.raft_z) + 1 + max(math.ceil((height - self.first_layer_z) / self.layer_height), 0)
+        # Step over the rounding either way
+        while layer > len(self.raft_z) + 1 and self.getLayerZ(layer - 1) >= height:
+            layer -= 1
+        while self.getLayerZ(layer) < height:
+            layer += 1
+        return layer
+
+#   The gcode for a pause, with %(name)f slots for the values that change from pause to pause: current_z, new_z, x, y, last_e and last_e_temp.
+#   Only the settings and the modes pick which lines go in, so there are just a few templates per run and each pause is one format call.
+@functools.lru_cache(maxsize = 64)
+def compilePauseTemplate(settings, pause_method, extruder_absolute_mode, position_absolute_mode):
+    # Build up the stuff that we're going to insert
+    # Gcode comments start with semi colon
+    # Put in a TYPE:CUSTOM header just so they know who (the script) added the following Gcode
+    prepend_gcode = ";TYPE:CUSTOM\n"
+    prepend_gcode += ";added code by post processing\n"
+    prepend_gcode += ";script: ChangeAtHeight.py\n"
+    prepend_gcode += ";current z: %(current_z)f\n"
+    
+    # Move X and Y
+    # Don't allow negative park values
+    park_x = max(settings.park_x, 0)
+    park_y = max(settings.park_y, 0)
+    # We're getting the Max X and Y values to make sure we don't go off the bed
+    # For Safety Leave a 10mm space (endstop)
+    max_x = settings.machine_width - 10
+    max_y = settings.machine_depth - 10
+    # Make sure x and y are within machine range
+    if park_x > max_x:
+        park_x = max_x
+    if park_y > max_y:
+        park_y = max_y
+    
+    # Wait until they're ready, with a beep to let them know that we paused
+    wait = "M117 Press Continue...\n"
+    if settings.beep:
+        wait += "M400  ;Wait for buffer to clear\n"
+        wait += "M300  ;Beep\n"
+    # Pause
+    if pause_method == 'm25':
+        wait += "M25 ; Pause\n"
+    elif pause_method == 'm0':
+        wait += "M0 Press to Continue...\n"
+    # Engage motors
+    lock_motors = ""
+    if position_absolute_mode:
+        lock_motors += "G91  ;Set to relative position mode\n"
+    lock_motors += "G1 X-0.1 Y-0.1 Z-0.1  ; Lock motors\n"
+    lock_motors += "G1 X0.1 Y0.1 Z0.1  ; Lock motors\n"
+    if position_absolute_mode:
+        lock_motors += "G90  ;Set back to absolute position mode\n"
+    
+    if pause_method == 'm600':
+        if settings.beep:
+            # Beep to let them know that we paused
+            prepend_gcode += "M400  ;Wait for buffer to clear\n"
+            prepend_gcode += "M300  ;Beep\n"
+        prepend_gcode += "M600 ; Filament Change\n"
+    else:
+        # Retraction
+        if extruder_absolute_mode:
+            prepend_gcode += "M83  ;Set extruder to relative mode\n"
+        prepend_gcode += "G1 E-%f F2400  ;Retract\n" % (settings.retraction_mm)
+        
+        # Move head away
+        # Z first
+        prepend_gcode += "G1 Z%(new_z)f F3000   ;Move head up\n"
+        # Now X and Y
+        prepend_gcode += "G1 X%f Y%f F3000   ;Move head away\n" % (park_x, park_y)
+        
+        # Cool down
+        if settings.cool_down:
+            # Turn off extruder temp
+            prepend_gcode += "M104 S0  ;Turn off extruder heat\n"
+        
+        prepend_gcode += wait
+        # Do normal pause if not changing filament (wants to pause)
+        if not settings.change_filament:
+            # Lock the motors and let the user do what they need to do while paused. Wait until they're ready
+            prepend_gcode += lock_motors
+            prepend_gcode += wait
+        # Heat back up
+        if settings.cool_down:
+            prepend_gcode += lock_motors
+            prepend_gcode += "M117 Heating extruder...\n"
+            prepend_gcode += "M109 S%(last_e_temp)f  ;Heat extruder back up\n"
+            # Beep to let them know that it is finished heating up
+            prepend_gcode += wait
+        if settings.change_filament:
+            prepend_gcode += lock_motors
+            # Push the filament back, and retract again. This properly primes the nozzle when changing filament.
+            if settings.prime_mm > 0:
+                prepend_gcode += ";Prime nozzle\n"
+                prepend_gcode += "G1 E%f F6000\n" % (settings.prime_mm + 1.0)
+                prepend_gcode += "G1 E-%f F6000\n" % (settings.prime_mm)
+            # Beep to let them know to clean up
+            prepend_gcode += wait
+            # Retraction
+            prepend_gcode += "G1 E-%f F2400 ;Retract\n" % (settings.retraction_mm)
+        # Move the head back
+        # X and Y first
+        prepend_gcode += "G1 X%(x)f Y%(y)f F3000  ;Move to next layer position\n"
+        # Then Z
+        prepend_gcode += "G1 Z%(current_z)f F3000  ;Move to next layer Z position\n"
+        # Extrusion
+        prepend_gcode += "G1 E%f F2400 ;Extrude\n" % (settings.extrusion_mm)
+        if extruder_absolute_mode:
+            prepend_gcode += "M82  ;Set extruder back to absolute mode\n"
+            prepend_gcode += "G92  E%(last_e)f  ;Set the extrude value to the previous (before last retraction)\n"
+        prepend_gcode += "M117 Printing...\n"
+    prepend_gcode += ";CUSTOM Pause Done\n"
+    return prepend_gcode
+
+# The state of the print that a pause needs, at a point in the file. The names are the same as the variables in ChangeAtHeight.scanLayer
+class PrintState:
+    __slots__ = ("pending", "last_e", "last_e_age", "last_e_temp", "extruder_absolute_mode", "position_absolute_mode", "current_layer", "currently_in_custom")
+
+    def __init__(self):
+        # The pauses that still have to be placed in the current print sequence
+        self.pending = []
+        self.last_e = 0.
+        self.last_e_age = 0
+        self.last_e_temp = 0.
+        # Default to absolute mode because most printers do, unless we find otherwise
+        self.extruder_absolute_mode = True
+        self.position_absolute_mode = True
+        self.current_layer = 0
+        self.currently_in_custom = False
+
+# What a layer does to the state of the print, found with a few regex passes over the whole layer instead of tokenizing every line.
+# It doesn't depend on the state the layer starts in, so applying it gives the same result as scanning the layer line by line.
+class LayerSummary:
+    __slots__ = ("layers", "last_e_temp", "extruder_absolute_mode", "position_absolute_mode", "e_values", "e_transition", "max_z")
+
+    def __init__(self):
+        # Number of ;LAYER: markers
+        self.layers = 0
+        # The last value set in the layer, None if the layer doesn't set it
+        self.last_e_temp = None
+        self.extruder_absolute_mode = None
+        self.position_absolute_mode = None
+        # Every E value in order, they're needed to follow the last highest E value
+        self.e_values = []
+        # The same thing as an ETransition, when the summary comes from the layer cache, which doesn't keep the E values
+        self.e_transition = None
+        # The highest Z value in the layer, None if there isn't one
+        self.max_z = None
+
+    #   Could any of the pending pauses be due somewhere in this layer?
+    def mayPause(self, state):
+        if not state.pending:
+            return False
+        top_layer = state.current_layer + self.layers
+        if top_layer <= 0:
+            return False
+        for pause in state.pending:
+            if pause.pause_type == 'height':
+                if self.max_z is not None and self.max_z >= pause.value:
+                    return True
+            elif top_layer >= pause.value:
+                return True
+        return False
+
+    #   Move the state from the start to the end of the layer
+    def apply(self, state):
+        state.current_layer += self.layers
+        if self.last_e_temp is not None:
+            state.last_e_temp = self.last_e_temp
+        if self.extruder_absolute_mode is not None:
+            state.extruder_absolute_mode = self.extruder_absolute_mode
+        if self.position_absolute_mode is not None:
+            state.position_absolute_mode = self.position_absolute_mode
+        if self.e_transition is not None:
+            state.last_e, state.last_e_age = self.e_transition.apply(state.last_e, state.last_e_age)
+        else:
+            state.last_e, state.last_e_age = foldLastE(self.e_values, state.last_e, state.last_e_age)
+
+    #   The summary as a list of plain values, to store in the layer cache
+    def toJson(self):
+        if self.e_transition is None:
+            self.e_transition = ETransition(self.e_values)
+        return [self.layers, self.last_e_temp, self.extruder_absolute_mode, self.position_absolute_mode, self.max_z, self.e_transition.toJson()]
+
+    @classmethod
+    def fromJson(cls, values):
+        summary = cls()
+        summary.layers, summary.last_e_temp, summary.extruder_absolute_mode, summary.position_absolute_mode, summary.max_z, e_transition = values
+        summary.e_transition = ETransition.fromJson(e_transition)
+        return summary
+
+#   Same as scanLayer: remember the last highest E, but forget the high values after three lower values.
+#   Returns last_e and last_e_age after going through all of the E values.
+def foldLastE(e_values, last_e, last_e_age):
+    for e in e_values:
+        if e > last_e:
+            last_e = e
+            last_e_age = 0
+        elif e < last_e:
+            if last_e_age < 3:
+                last_e_age = last_e_age + 1
+            else:
+                last_e = e
+                last_e_age = 0
+    return last_e, last_e_age
+
+#   What the E values of a layer do to last_e and last_e_age, for every state the layer can start in, without keeping the values themselves.
+#   There are only three cases, depending on how last_e compares to the highest E value in the layer (max_e):
+#   - lower: the first max_e always becomes the new last_e, so the end state is the same whatever the start was (exit_lower)
+#   - higher: every value is lower, so the first reset is at the (4 - last_e_age)th value. One end state per starting age (exits_higher)
+#   - equal: the same, but values equal to last_e don't count (exits_equal)
+#   If there aren't enough lower values for a reset, last_e stays and only the age goes up.
+class ETransition:
+    __slots__ = ("count", "max_e", "count_lower", "exit_lower", "exits_higher", "exits_equal")
+
+    def __init__(self, e_values = ()):
+        values = list(e_values)
+        self.count = len(values)
+        self.max_e = None
+        self.count_lower = 0
+        self.exit_lower = None
+        self.exits_higher = [None] * 4
+        self.exits_equal = [None] * 4
+        if not values:
+            return
+        self.max_e = max(values)
+        self.exit_lower = self.foldFrom(e_values, values.index(self.max_e))
+        lower = [index for index, e in enumerate(values) if e < self.max_e]
+        self.count_lower = len(lower)
+        for last_e_age in range(4):
+            if 3 - last_e_age < len(values):
+                self.exits_higher[last_e_age] = self.foldFrom(e_values, 3 - last_e_age)
+            if 3 - last_e_age < len(lower):
+                self.exits_equal[last_e_age] = self.foldFrom(e_values, lower[3 - last_e_age])
+
+    #   The end state when the value at index resets last_e
+    @staticmethod
+    def foldFrom(e_values, index):
+        return foldLastE(e_values[index + 1:], e_values[index], 0)
+
+    #   Same result as foldLastE over the values this was made from
+    def apply(self, last_e, last_e_age):
+        if self.count == 0:
+            return last_e, last_e_age
+        if last_e < self.max_e:
+            return self.exit_lower
+        if last_e > self.max_e:
+            lower = self.count
+            exits = self.exits_higher
+        else:
+            lower = self.count_lower
+            exits = self.exits_equal
+        if last_e_age + lower <= 3:
+            return last_e, last_e_age + lower
+        return exits[last_e_age]
+
+    def toJson(self):
+        return [self.count, self.max_e, self.count_lower, self.exit_lower, self.exits_higher, self.exits_equal]
+
+    @classmethod
+    def fromJson(cls, values):
+        transition = cls()
+        transition.count, transition.max_e, transition.count_lower, exit_lower, exits_higher, exits_equal = values
+        transition.exit_lower = tuple(exit_lower) if exit_lower is not None else None
+        transition.exits_higher = [tuple(end) if end is not None else None for end in exits_higher]
+        transition.exits_equal = [tuple(end) if end is not None else None for end in exits_equal]
+        return transition
+
+# Layer summaries kept on disk between runs, keyed by a hash of the layer.
+# When a model is sliced again with small changes, most layers are exactly the same, and their summaries come from here instead of going through the layer again.
+# It's an sqlite database that keeps up to max_entries summaries. Every run counts as one use, and the summaries that haven't been used for the most runs are dropped first.
+# The database's user_version is the LAYER_CACHE_VERSION it was written with, when that's not the current one all of the summaries are dropped.
+class LayerCache:
+    def __init__(self, path, max_entries = LAYER_CACHE_SIZE):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            # Other processes can open the same cache at the same time, only one of them gets to check the version and drop the summaries
+            self.connection.execute("BEGIN IMMEDIATE")
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != LAYER_CACHE_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS layers")
+                self.connection.execute("PRAGMA user_version = %d" % LAYER_CACHE_VERSION)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS layers (hash BLOB PRIMARY KEY, summary TEXT NOT NULL, used INTEGER NOT NULL)")
+        self.run = (self.connection.execute("SELECT MAX(used) FROM layers").fetchone()[0] or 0) + 1
+        # Written in one go when the run is done
+        self.used = []
+        self.added = []
+        self.hits = 0
+        self.misses = 0
+        # False once the cache failed, then it isn't used for the rest of the run
+        self.enabled = True
+
+    @staticmethod
+    def getKey(layer, start = 0, end = None):
+        if isinstance(layer, str):
+            data = layer.encode("utf-8", "surrogateescape")
+        else:
+            # The same bytes the string would encode to, straight from the buffer
+            data = memoryview(layer)[start:end]
+        return hashlib.blake2b(data, digest_size = 16).digest()
+
+    #   The cached summary of a layer, or None.
+    #   When the database can't be read, or has a summary in it that can't be, that's a miss and the cache is turned off: the pauses are placed without it
+    def get(self, key):
+        try:
+            row = self.connection.execute("SELECT summary FROM layers WHERE hash = ?", (key,)).fetchone()
+            summary = None if row is None else LayerSummary.fromJson(json.loads(row[0]))
+        except (sqlite3.Error, ValueError, TypeError, IndexError):
+            self.enabled = False
+            summary = None
+        if summary is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((self.run, key))
+        return summary
+
+    def put(self, key, summary):
+        self.added.append((key, json.dumps(summary.toJson()), self.run))
+
+    #   Write what this run used and added, and drop the least recently used summaries if there are too many. Nothing is written when the cache was turned off
+    def close(self):
+        if not self.enabled:
+            self.connection.close()
+            return
+        with self.connection:
+            self.connection.executemany("UPDATE layers SET used = ? WHERE hash = ?", self.used)
+            self.connection.executemany("INSERT OR REPLACE INTO layers (hash, summary, used) VALUES (?, ?, ?)", self.added)
+            count = self.connection.execute("SELECT COUNT(*) FROM layers").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM layers WHERE hash IN (SELECT hash FROM layers ORDER BY used LIMIT ?)", (count - self.max_entries,))
+        self.connection.close()
+
+# What summarizeLayer looks for, as str for layers that are strings, and as bytes for layers that are still in a file buffer (see processBuffer)
+class LayerPatterns:
+    def __init__(self, encode):
+        self.custom = encode("CUSTOM")
+        self.layer_count = encode(";LAYER_COUNT:")
+        self.layer = encode(";LAYER:")
+        self.newline = encode("\n")
+        self.comment = encode(";")
+        self.modal_hints = tuple(encode(hint) for hint in MODAL_HINTS)
+        self.number_re = re.compile(encode(NUMBER_RE.pattern))
+        self.e_value_re = re.compile(encode(E_VALUE_RE.pattern), re.M)
+        self.z_value_re = re.compile(encode(Z_VALUE_RE.pattern))
+        self.modal_re = re.compile(encode(MODAL_RE.pattern))
+
+STR_PATTERNS = LayerPatterns(str)
+BYTES_PATTERNS = LayerPatterns(lambda text: text.encode("ascii"))
+
+#   Summarize a layer, or return None if it has to be scanned line by line.
+#   That's the case when it has CUSTOM blocks, a LAYER_COUNT (which starts a new print sequence) or a G92 (which resets E in the middle of the E values).
+#   layer is a string, or a bytes-like buffer like an mmap with the layer between start and end, which is summarized without copying it out.
+def summarizeLayer(layer, start = 0, end = None):
+    patterns = STR_PATTERNS if isinstance(layer, str) else BYTES_PATTERNS
+    if end is None:
+        end = len(layer)
+    if layer.find(patterns.custom, start, end) != -1 or layer.find(patterns.layer_count, start, end) != -1:
+        return None
+    summary = LayerSummary()
+    # Only a handful of lines change the modal state, tokenize just those
+    previous_line_start = -1
+    has_modal = False
+    for hint in patterns.modal_hints:
+        if layer.find(hint, start, end) != -1:
+            has_modal = True
+            break
+    for match in (patterns.modal_re.finditer(layer, start, end) if has_modal else ()):
+        line_start = max(layer.rfind(patterns.newline, start, match.start()) + 1, start)
+        if line_start == previous_line_start:
+            continue
+        previous_line_start = line_start
+        line_end = layer.find(patterns.newline, line_start, end)
+        if line_end == -1:
+            line_end = end
+        line = layer[line_start:line_end]
+        if patterns is BYTES_PATTERNS:
+            line = line.decode("utf-8", "surrogateescape")
+        params = tokenizeLine(line).params
+        m = params.get("M")
+        if m == 104 or m == 109:
+            s = params.get("S")
+            if s is not None:
+                summary.last_e_temp = s
+        elif m == 82:
+            summary.extruder_absolute_mode = True
+        elif m == 83:
+            summary.extruder_absolute_mode = False
+        g = params.get("G")
+        if g == 90:
+            summary.position_absolute_mode = True
+        elif g == 91:
+            summary.position_absolute_mode = False
+        elif g == 92:
+            return None
+    # Count the ;LAYER: markers that are the first comment on their line
+    position = layer.find(patterns.layer, start, end)
+    while position != -1:
+        line_start = max(layer.rfind(patterns.newline, start, position) + 1, start)
+        if layer.find(patterns.comment, line_start, position) == -1 and patterns.number_re.match(layer, position + 7, end) is not None:
+            summary.layers += 1
+        position = layer.find(patterns.layer, position + 7, end)
+    e_values = patterns.e_value_re.findall(layer, start, end)
+    summary.e_values = list(map(float, e_values))
+    summary.max_z = max(map(float, patterns.z_value_re.findall(layer, start, end)), default = None)
+    return summary
+
+# Counters and phase timings of a run, for finding out why post processing is slow. Only made when the performance_report setting is on, otherwise it's NULL_STATS.
+# The phases are:
+# - summarize: making the layer summaries, the regex passes over whole layers (or getting them from the layer cache)
+# - parse: splitting the layers that have to be scanned into lines
+# - scan: going through the lines of a layer in scanLayer, which includes tokenizing them
+# - track: following the state of the print over a layer by applying its summary
+# - build: making the pause blocks
+# - splice: putting the layers with a pause back together
+# A phase that runs inside another one (build inside scan) isn't counted in the outer one.
+class RunStats:
+    enabled = True
+
+    def __init__(self):
+        self.counters = dict.fromkeys(("layers", "layers_scanned", "layers_spliced", "layers_fast_forwarded", "layers_caught_up", "lines_scanned", "custom_lines_skipped", "lines_tokenized", "summaries", "pauses", "bytes_copied"), 0)
+        self.phases = dict.fromkeys(("summarize", "parse", "scan", "track", "build", "splice"), 0.)
+        # The phases that are running, innermost last
+        self.running = []
+        self.start_time = time.perf_counter()
+        self.seconds = None
+
+    def count(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    #   A layer was scanned line by line, which copied it once to split it
+    def countScan(self, lines, layer):
+        self.counters["layers_scanned"] += 1
+        self.counters["lines_scanned"] += lines
+        self.counters["bytes_copied"] += getByteSize(layer)
+
+    #   A layer got pauses, and was made again
+    def countSplice(self, pauses, layer):
+        if pauses:
+            self.counters["layers_spliced"] += 1
+            self.counters["pauses"] += pauses
+            self.counters["bytes_copied"] += getByteSize(layer)
+
+    #   Use as "with stats.phase(name):"
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def finish(self, layer_count):
+        self.seconds = time.perf_counter() - self.start_time
+        self.counters["layers"] = layer_count
+        self.counters["lines_tokenized"] = self.counters["lines_scanned"] - self.counters["custom_lines_skipped"]
+
+    #   Everything as plain values, for the JSON report. The run time includes whatever is done with the layers in between, eg. writing them to a file
+    def getReport(self):
+        return {
+            "script": "ChangeAtHeight " + ChangeAtHeight.version,
+            "seconds": self.seconds,
+            "counters": self.counters,
+            "phase_seconds": self.phases,
+            "lines_per_second": self.counters["lines_scanned"] / self.phases["scan"] if self.phases["scan"] else None,
+        }
+
+    def writeReport(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with open(path, "w") as f:
+            json.dump(self.getReport(), f, indent = 2, sort_keys = True)
+
+    #   A short version of the report, as a comment to go at the end of the g-code
+    def getSummaryComment(self):
+        counters = self.counters
+        phases = ", ".join("%s %.3fs" % (name, seconds) for name, seconds in self.phases.items())
+        return ";ChangeAtHeight report: %d layers, %d scanned (%d lines, %d in custom blocks), %d fast-forwarded, %d pauses, %d bytes copied, %.3fs (%s)\n" % (
+            counters["layers"], counters["layers_scanned"], counters["lines_scanned"], counters["custom_lines_skipped"], counters["layers_fast_forwarded"], counters["pauses"], counters["bytes_copied"], self.seconds or 0., phases)
+
+#   Size of a layer in bytes as it is in the file, for a string or a bytes-like layer
+def getByteSize(layer):
+    if isinstance(layer, str):
+        return len(layer.encode("utf-8", "surrogateescape"))
+    return len(layer)
+
+class PhaseTimer:
+    __slots__ = ("stats", "name", "start", "nested")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.
+        self.stats.running.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        running = self.stats.running
+        running.pop()
+        self.stats.phases[self.name] += elapsed - self.nested
+        if running:
+            running[-1].nested += elapsed
+        return False
+
+# What the script uses when the performance report is off. Every call does nothing, so a run costs the same as without the counters.
+class NullStats:
+    enabled = False
+
+    def count(self, name, amount = 1):
+        pass
+
+    def countScan(self, lines, layer):
+        pass
+
+    def countSplice(self, pauses, layer):
+        pass
+
+    def phase(self, name):
+        return NULL_PHASE
+
+class NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STATS = NullStats()
+NULL_PHASE = NullPhase()
+
 class ChangeAtHeight(Script):
     version = "3.4"
     def __init__(self):
         super().__init__()
+        # machine_width, machine_depth and machine_height, when they don't come from the printer in Cura
+        self.machine_settings = None
+        # Where to keep the layer cache when it's on. In Cura it goes in Cura's cache folder
+        self.layer_cache_path = None
+        self.layer_cache_size = LAYER_CACHE_SIZE
+        # The PauseSettings of the current run, read when the first pause is placed, and the templates for them by pause method and modes
+        self.pause_settings = None
+        self.pause_templates = {}
+        # Counters and timings of the current run, see RunStats. Where to write them as JSON when performance_report is on, in Cura next to the layer cache
+        self.stats = NULL_STATS
+        self.report_path = None
+        # Anything with enable() and disable(), like a cProfile.Profile. It's switched on while the script works on a layer and off while the layer is handed on
+        self.profiler = None
+        # Looks up the material names in the pause schedule, anything with getTemperature(name), see material_library.MachineMaterials. Cura doesn't set it
+        self.material_library = None
+        # The layer height settings (see getLayerHeights), when they don't come from the print in Cura, eg. from cura_profile.readPrintSettings
+        self.print_settings = None
     
     def getSettingDataString(self):
         return """{
@@ -25,9 +783,9 @@ class ChangeAtHeight(Script):
                 "pause_type":
                 {
                     "label": "Pause type",
-                    "description": "Pause at height or at layer number.",
+                    "description": "Pause at height, at layer number, or at every pause in a schedule.",
                     "type": "enum",
-                    "options": {"height":"Height","layer":"Layer"},
+                    "options": {"height":"Height","layer":"Layer","schedule":"Schedule"},
                     "default_value": "layer"
                 },
                 "pause_method":
@@ -58,6 +816,22 @@ class ChangeAtHeight(Script):
                     "default_value": 1,
                     "enabled": "pause_type == 'layer'"
                 },
+                "pause_schedule":
+                {
+                    "label": "Pause schedule",
+                    "description": "Comma separated list of pauses, all placed in one pass. A plain number is a layer (first layer is 1), a number followed by mm is a height. Add :m25, :m0 or :m600 to use a different pause method for that pause, and @ with a temperature to heat back up to a different temperature after that pause. eg. 5, 12.5mm:m600, 20:m0@235",
+                    "type": "str",
+                    "default_value": "",
+                    "enabled": "pause_type == 'schedule'"
+                },
+                "pause_height_as_layer":
+                {
+                    "label": "Pause height by layer",
+                    "description": "Work out which layer a pause height is at from the layer height settings, and pause at that layer. Only right for g-code sliced with these settings. Not used with adaptive layers.",
+                    "type": "bool",
+                    "default_value": false,
+                    "enabled": "pause_type != 'layer'"
+                },
                 "change_filament":
                 {
                     "label": "Change filament at pause",
@@ -74,6 +848,16 @@ class ChangeAtHeight(Script):
                     "default_value": true,
                     "enabled": "pause_method != 'm600'"
                 },
+                "resume_temperature":
+                {
+                    "label": "Resume temperature",
+                    "description": "The temperature to heat the extruder back up to after cooling down, eg. for the filament that goes in at the pause. 0 uses the last temperature set in the g-code.",
+                    "unit": "°C",
+                    "type": "float",
+                    "default_value": 0,
+                    "minimum_value": "0",
+                    "enabled": "cool_down and pause_method != 'm600'"
+                },
                 "beep":
                 {
                     "label": "Beep",
@@ -148,315 +932,497 @@ class ChangeAtHeight(Script):
                     "minimum_value": "0",
                     "default_value": 5,
                     "enabled": "pause_method != 'm600'"
+                },
+                "cache_layers":
+                {
+                    "label": "Cache layers",
+                    "description": "Remember what every layer does on disk, so slicing the same model again with small changes only has to go through the layers that changed.",
+                    "type": "bool",
+                    "default_value": false
+                },
+                "performance_report":
+                {
+                    "label": "Performance report",
+                    "description": "Count and time what the script does, and add a summary of it as a comment at the end of the g-code. For finding out why post processing is slow.",
+                    "type": "bool",
+                    "default_value": false
                 }
             }
         }"""
     
-    #   Convenience function that finds the value in a line of g-code.
-    #   When requesting key = x from line "G1 X100" the value 100 is returned.
-    #   Override original function, which didn't handle values without a leading zero like ".3"
-    #   Ignores keys found in comments (after ";"), but if you pass the semicolon in, you're good. eg. ";LAYER:"
-    def getValue(self, line, key, default = None):
-        if not key in line or (';' in line and line.find(key) > line.find(';')):
-            return default
-        sub_part = line[line.find(key) + len(key):]
-        m = re.search('^-?[0-9]+\.?[0-9]*', sub_part)
-        if m is None:
-            m = re.search('^-?[0-9]*\.?[0-9]+', sub_part)
-        if m is None:
-            return default
-        try:
-            return float(m.group(0))
-        except:
-            return default
+    #   Get a machine setting (machine_width, machine_depth or machine_height) from the printer in Cura, or from machine_settings when it's set
+    def getMachineProperty(self, key):
+        if self.machine_settings is not None:
+            return self.machine_settings[key]
+        return Application.getInstance().getGlobalContainerStack().getProperty(key, "value")
     
-    def execute(self, data):
-        # Initialize variables
-        ready = False
+    #   Get a setting of the print (see LayerHeights) from the print settings in Cura, or from print_settings when it's set
+    def getPrintProperty(self, key):
+        if self.print_settings is not None:
+            return self.print_settings.get(key)
+        if Application is None:
+            raise ValueError("Pause heights can only be turned into layers with the print settings, eg. from a Cura profile")
+        return Application.getInstance().getGlobalContainerStack().getProperty(key, "value")
+    
+    #   Where the layers are, from the print settings. None with adaptive layers, where the layer heights are only known from the g-code
+    def getLayerHeights(self):
+        if self.getPrintProperty("adaptive_layer_height_enabled"):
+            return None
+        layer_height = self.getPrintProperty("layer_height")
+        first_layer_z = self.getPrintProperty("layer_height_0")
+        raft_z = []
+        if self.getPrintProperty("adhesion_type") == "raft":
+            # A base layer, the interface layers and the surface layers, then the model above the air gap, which the first layer of the model reaches into
+            z = self.getPrintProperty("raft_base_thickness")
+            raft_z.append(z)
+            # Cura's own defaults for the number of layers when the print settings don't have them. 0 is a valid number of layers
+            interface_layers = self.getPrintProperty("raft_interface_layers")
+            surface_layers = self.getPrintProperty("raft_surface_layers")
+            for layer in range(1 if interface_layers is None else int(interface_layers)):
+                z += self.getPrintProperty("raft_interface_thickness")
+                raft_z.append(z)
+            for layer in range(2 if surface_layers is None else int(surface_layers)):
+                z += self.getPrintProperty("raft_surface_thickness")
+                raft_z.append(z)
+            first_layer_z += z + self.getPrintProperty("raft_airgap") - self.getPrintProperty("layer_0_z_overlap")
+        return LayerHeights(tuple(raft_z), first_layer_z, layer_height)
+    
+    #   The settings and machine size the pauses are made from, read once per run
+    def getPauseSettings(self):
+        return PauseSettings(
+            park_x = self.getSettingValueByKey("head_park_x"),
+            park_y = self.getSettingValueByKey("head_park_y"),
+            move_z = self.getSettingValueByKey("head_move_z"),
+            min_head_park_z = self.getSettingValueByKey("min_head_park_z"),
+            retraction_mm = self.getSettingValueByKey("retraction_mm"),
+            extrusion_mm = self.getSettingValueByKey("extrusion_mm"),
+            prime_mm = self.getSettingValueByKey("prime_mm"),
+            beep = bool(self.getSettingValueByKey("beep")),
+            cool_down = bool(self.getSettingValueByKey("cool_down")),
+            change_filament = bool(self.getSettingValueByKey("change_filament")),
+            machine_width = self.getMachineProperty("machine_width"),
+            machine_depth = self.getMachineProperty("machine_depth"),
+            machine_height = self.getMachineProperty("machine_height"))
+    
+    #   Build the gcode for one pause, using the state of the print at the line we're pausing in front of
+    def getPauseGcode(self, pause_method, current_z, x, y, last_e, last_e_temp, extruder_absolute_mode, position_absolute_mode):
+        with self.stats.phase("build"):
+            if self.pause_settings is None:
+                self.pause_settings = self.getPauseSettings()
+                self.pause_templates = {}
+            settings = self.pause_settings
+            key = (pause_method, bool(extruder_absolute_mode), bool(position_absolute_mode))
+            template = self.pause_templates.get(key)
+            if template is None:
+                template = self.pause_templates[key] = compilePauseTemplate(settings, *key)
+            return template % {"current_z": current_z, "new_z": settings.getNewZ(current_z), "x": x, "y": y, "last_e": last_e, "last_e_temp": last_e_temp}
+    
+    #   Walk the lines of one layer, keeping track of the state of the print and placing any pause that is due.
+    #   state is updated in place. Returns the (line index, gcode) insertions for this layer.
+    #   get_command(line_index) can give the tokenized lines when they are shared with other scripts, see post_processing_chain.py
+    def scanLayer(self, lines, state, pauses, get_command = None):
+        # Copy the state into local variables, this is the hot loop
+        pending = state.pending
+        last_e = state.last_e
+        last_e_age = state.last_e_age
+        last_e_temp = state.last_e_temp
+        extruder_absolute_mode = state.extruder_absolute_mode
+        position_absolute_mode = state.position_absolute_mode
+        current_layer = state.current_layer
+        currently_in_custom = state.currently_in_custom
         x = None
         y = None
-        last_e = 0.
-        last_e_age = 0
-        last_e_temp = 0.
         current_z = None
-        current_layer = 0
-        currently_in_custom = False
-        # Default to absolute mode because most printers do, unless we find otherwise
-        extruder_absolute_mode = True
-        position_absolute_mode = True
-        # Get the user values into variables
-        pause_type = self.getSettingValueByKey("pause_type")
-        pause_method = self.getSettingValueByKey("pause_method")
-        pause_z = self.getSettingValueByKey("pause_height")
-        pause_layer = self.getSettingValueByKey("pause_layer")
-        park_x = self.getSettingValueByKey("head_park_x")
-        park_y = self.getSettingValueByKey("head_park_y")
-        move_z = self.getSettingValueByKey("head_move_z")
-        retraction_mm = self.getSettingValueByKey("retraction_mm")
-        extrusion_mm = self.getSettingValueByKey("extrusion_mm")
-        prime_mm = self.getSettingValueByKey("prime_mm")
-        min_head_park_z = self.getSettingValueByKey("min_head_park_z")
-        
-        # Iterate through all the layers
-        for layer in data:
-            lines = layer.split("\n")
-            # Iterate through the lines for each layer
-            for line in lines:
-                # Skip lines inside of CUSTOM
-                if currently_in_custom:
-                    if ';CUSTOM' in line:
-                        currently_in_custom = False
-                    continue
-                elif ';TYPE:CUSTOM' in line:
-                    currently_in_custom = True
-                    continue
-                
-                # We're not inside 'CUSTOM', now start processing
+        custom_lines = 0
+        # The pause blocks to put in this layer, as (line index, gcode). The layer is only put back together once, after all of its lines are done
+        insertions = []
+        # Iterate through the lines for each layer
+        for line_index, line in enumerate(lines):
+            # Skip lines inside of CUSTOM
+            if currently_in_custom:
+                custom_lines += 1
+                if ';CUSTOM' in line:
+                    currently_in_custom = False
+                continue
+            elif ';TYPE:CUSTOM' in line:
+                currently_in_custom = True
+                continue
+            
+            # We're not inside 'CUSTOM', now start processing
+            # Parse the line once, everything below reads the values from the parsed command
+            command = tokenizeLine(line) if get_command is None else get_command(line_index)
+            params = command.params
+            if command.comment:
                 # The LAYER_COUNT always comes before the LAYER, so LAYER_COUNT resets the layer. This is to let us work for print sequence: One at a Time
-                lc = self.getValue(line, ";LAYER_COUNT:")
+                lc = command.getMarker(";LAYER_COUNT:")
                 if lc is not None:
                     current_layer = 0
-                    ready = True
+                    pending = list(pauses)
                     continue
                 # Get the current LAYER number
                 # They start at 0, unless they're using a raft, then it starts negative
-                l = self.getValue(line, ";LAYER:")
+                l = command.getMarker(";LAYER:")
                 if l is not None:
                     current_layer = current_layer + 1
-                
-                # Get the E (extrusion) value from the current line. Will be None if none.
-                e = self.getValue(line, "E")
-                # Remember the last highest E (extrusion) value so that we can resume there after a pause
-                if e is not None and e > last_e:
+            
+            # Nothing but a comment on this line, there are no values to track
+            if command.letter is None:
+                continue
+            
+            # Get the E (extrusion) value from the current line. Will be None if none.
+            e = params.get("E")
+            # Remember the last highest E (extrusion) value so that we can resume there after a pause
+            if e is not None and e > last_e:
+                last_e = e
+                last_e_age = 0
+            
+            # This is to handle those anomalous high E values, we'll forget the high values after three lower values
+            if e is not None and e < last_e:
+                if last_e_age < 3:
+                    last_e_age = last_e_age + 1
+                else:
                     last_e = e
                     last_e_age = 0
+            
+            # Get the current extruder temp
+            # Get the M (RepRap command) value from the current line.  Will be None if none.
+            m = params.get("M")
+            if m is not None:
+                if m == 104 or m == 109:
+                    # Nozzle temps
+                    # Get the S (command parameter) value
+                    s = params.get("S")
+                    if s is not None:
+                        last_e_temp = s
+                elif m == 82:
+                    # Extruder absolute mode
+                    extruder_absolute_mode = True
+                elif m == 83:
+                    # Extruder relative mode
+                    extruder_absolute_mode = False
+            # Get the G value. G0 and G1 are moves. Will be None if none.
+            g = params.get("G")
+            
+            # Did they reset the extruder value?
+            if g == 90:
+                position_absolute_mode = True
+            elif g == 91:
+                position_absolute_mode = False
+            elif g == 92:
+                x = params.get("X")
+                y = params.get("Y")
+                z = params.get("Z")
+                if e is None and x is None and y is None and z is None: 
+                    last_e = 0.
+                if e is not None:
+                    last_e = e
+            elif g == 1 or g == 0:
+                # It was a move, get the X and Y values from the move line
+                x = params.get("X")
+                y = params.get("Y")
                 
-                # This is to handle those anomalous high E values, we'll forget the high values after three lower values
-                if e is not None and e < last_e:
-                    if last_e_age < 3:
-                        last_e_age = last_e_age + 1
-                    else:
-                        last_e = e
-                        last_e_age = 0
-                
-                # Get the current extruder temp
-                # Get the M (RepRap command) value from the current line.  Will be None if none.
-                m = self.getValue(line, "M")
-                if m is not None:
-                    if m == 104 or m == 109:
-                        # Nozzle temps
-                        # Get the S (command parameter) value
-                        s = self.getValue(line, "S")
-                        if s is not None:
-                            last_e_temp = s
-                    elif m == 82:
-                        # Extruder absolute mode
-                        extruder_absolute_mode = True
-                    elif m == 83:
-                        # Extruder relative mode
-                        extruder_absolute_mode = False
-                # Get the G value. G0 and G1 are moves. Will be None if none.
-                g = self.getValue(line, "G")
+                # Not every line will have a Z value, but at least the first move on each layer will have one when it moves to that Z height. If we record the Z value, that will always be our current Z height
+                # Get the Z value. Will be None if none
+                current_z = params.get("Z")
                 
-                # Did they reset the extruder value?
-                if g == 90:
-                    position_absolute_mode = True
-                elif g == 91:
-                    position_absolute_mode = False
-                elif g == 92:
-                    x = self.getValue(line, "X")
-                    y = self.getValue(line, "Y")
-                    z = self.getValue(line, "Z")
-                    if e is None and x is None and y is None and z is None: 
-                        last_e = 0.
-                    if e is not None:
-                        last_e = e
-                elif g == 1 or g == 0:
-                    # It was a move, get the X and Y values from the move line
-                    x = self.getValue(line, "X")
-                    y = self.getValue(line, "Y")
-                    
-                    # Not every line will have a Z value, but at least the first move on each layer will have one when it moves to that Z height. If we record the Z value, that will always be our current Z height
-                    # Get the Z value. Will be None if none
-                    current_z = self.getValue(line, "Z")
-                    
-                    # If we have a height, and we're at least at the first layer, and we're moving, then it's time to see if we should pause
-                    if ready and current_layer > 0 and current_z is not None and x is not None and y is not None:
-                        # If the current height >= where they want to pause, then we want to pause before we do the next move
-                        if (pause_type == 'height' and current_z >= pause_z) or (pause_type == 'layer' and current_layer >= pause_layer):
-                            # We need to know where in the file we are in relation to layer and line so we can insert some stuff there
-                            data_index = data.index(layer)
-                            line_index = lines.index(line)
-                            
-                            # Build up the stuff that we're going to insert
-                            # Gcode comments start with semi colon
-                            # Put in a TYPE:CUSTOM header just so they know who (the script) added the following Gcode
-                            prepend_gcode = ";TYPE:CUSTOM\n"
-                            prepend_gcode += ";added code by post processing\n"
-                            prepend_gcode += ";script: ChangeAtHeight.py\n"
-                            prepend_gcode += ";current z: %f\n" % (current_z)
-                            
-                            # Move nozzle away from the bed so they can get their fingers under the nozzle
-                            # Don't allow negative moveZ value. That would be bad. They would hit their print.
-                            if move_z < 0:
-                                move_z = 0
-                            
-                            new_z = 0
-                            # Always move up to at least min z park value
-                            if current_z + move_z < min_head_park_z:
-                                new_z = min_head_park_z
-                            else:
-                                # We're getting the Max Z value from their print settings to make sure we don't go higher than their printer allows
-                                # For Safety Leave a 10mm space (endstop)
-                                max_z = Application.getInstance().getGlobalContainerStack().getProperty("machine_height", "value") - 10
-                                new_z = current_z + move_z
-                                if new_z > max_z:
-                                    new_z = max_z
-                            
-                            # Move X and Y
-                            # Don't allow negative park values
-                            if park_x < 0:
-                                park_x = 0
-                            if park_y < 0:
-                                park_y = 0
-                            
-                            # We're getting the Max X and Y values to make sure we don't go off the bed
-                            # For Safety Leave a 10mm space (endstop)
-                            max_x = Application.getInstance().getGlobalContainerStack().getProperty("machine_width", "value") - 10
-                            # For Safety Leave a 10mm space (endstop)
-                            max_y = Application.getInstance().getGlobalContainerStack().getProperty("machine_depth", "value") - 10
-                            # Make sure x and y are within machine range
-                            if park_x > max_x:
-                                park_x = max_x
-                            if park_y > max_y:
-                                park_y = max_y
-                            
-                            if pause_method == 'm600':
-                                if self.getSettingValueByKey("beep"):
-                                    # Beep to let them know that we paused
-                                    prepend_gcode += "M400  ;Wait for buffer to clear\n"
-                                    prepend_gcode += "M300  ;Beep\n"
-                                prepend_gcode += "M600 ; Filament Change\n"
-                            else:
-                                # Retraction
-                                if extruder_absolute_mode:
-                                    prepend_gcode += "M83  ;Set extruder to relative mode\n"
-                                prepend_gcode += "G1 E-%f F2400  ;Retract\n" % (retraction_mm)
-                                
-                                # Move head away
-                                # Z first
-                                prepend_gcode += "G1 Z%f F3000   ;Move head up\n" % (new_z)
-                                # Now X and Y
-                                prepend_gcode += "G1 X%f Y%f F3000   ;Move head away\n" % (park_x, park_y)
-                                
-                                # Cool down
-                                if self.getSettingValueByKey("cool_down"):
-                                    # Turn off extruder temp
-                                    prepend_gcode += "M104 S0  ;Turn off extruder heat\n"
-                                
-                                # Wait until they're ready
-                                prepend_gcode += "M117 Press Continue...\n"
-                                if self.getSettingValueByKey("beep"):
-                                    # Beep to let them know that we paused
-                                    prepend_gcode += "M400  ;Wait for buffer to clear\n"
-                                    prepend_gcode += "M300  ;Beep\n"
-                                # Pause
-                                if pause_method == 'm25':
-                                    prepend_gcode += "M25 ; Pause\n"
-                                elif pause_method == 'm0':
-                                    prepend_gcode += "M0 Press to Continue...\n"
-                                # Do normal pause if not changing filament (wants to pause)
-                                if not self.getSettingValueByKey("change_filament"):
-                                    # Lock the motors and let the user do what they need to do while paused. Wait until they're ready
-                                    # Engage motors
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G91  ;Set to relative position mode\n"
-                                    prepend_gcode += "G1 X-0.1 Y-0.1 Z-0.1  ; Lock motors\n"
-                                    prepend_gcode += "G1 X0.1 Y0.1 Z0.1  ; Lock motors\n"
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G90  ;Set back to absolute position mode\n"
-                                    # Wait until they're ready
-                                    prepend_gcode += "M117 Press Continue...\n"
-                                    if self.getSettingValueByKey("beep"):
-                                        # Beep to let them know that we paused
-                                        prepend_gcode += "M400  ;Wait for buffer to clear\n"
-                                        prepend_gcode += "M300  ;Beep\n"
-                                    # Pause
-                                    if pause_method == 'm25':
-                                        prepend_gcode += "M25 ; Pause\n"
-                                    elif pause_method == 'm0':
-                                        prepend_gcode += "M0 Press to Continue...\n"
-                                # Heat back up
-                                if self.getSettingValueByKey("cool_down"):
-                                    # Engage motors
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G91  ;Set to relative position mode\n"
-                                    prepend_gcode += "G1 X-0.1 Y-0.1 Z-0.1  ; Lock motors\n"
-                                    prepend_gcode += "G1 X0.1 Y0.1 Z0.1  ; Lock motors\n"
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G90  ;Set back to absolute position mode\n"
-                                    # Heat back up
-                                    prepend_gcode += "M117 Heating extruder...\n"
-                                    prepend_gcode += "M109 S%f  ;Heat extruder back up\n" % (last_e_temp)
-                                    prepend_gcode += "M117 Press Continue...\n"
-                                    if self.getSettingValueByKey("beep"):
-                                        # Beep to let them know that it is finished heating up
-                                        prepend_gcode += "M400  ;Wait for buffer to clear\n"
-                                        prepend_gcode += "M300  ;Beep\n"
-                                    # Pause
-                                    if pause_method == 'm25':
-                                        prepend_gcode += "M25 ; Pause\n"
-                                    elif pause_method == 'm0':
-                                        prepend_gcode += "M0 Press to Continue...\n"
-                                if self.getSettingValueByKey("change_filament"):
-                                    # Engage motors
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G91  ;Set to relative position mode\n"
-                                    prepend_gcode += "G1 X-0.1 Y-0.1 Z-0.1  ; Lock motors\n"
-                                    prepend_gcode += "G1 X0.1 Y0.1 Z0.1  ; Lock motors\n"
-                                    if position_absolute_mode:
-                                        prepend_gcode += "G90  ;Set back to absolute position mode\n"
-                                    # Push the filament back, and retract again. This properly primes the nozzle when changing filament.
-                                    if prime_mm > 0:
-                                        prepend_gcode += ";Prime nozzle\n"
-                                        prepend_gcode += "G1 E%f F6000\n" % (prime_mm + 1.0)
-                                        prepend_gcode += "G1 E-%f F6000\n" % (prime_mm)
-                                    prepend_gcode += "M117 Press Continue...\n"
-                                    if self.getSettingValueByKey("beep"):
-                                        # Beep to let them know to clean up
-                                        prepend_gcode += "M400  ;Wait for buffer to clear\n"
-                                        prepend_gcode += "M300  ;Beep\n"
-                                    # Pause
-                                    if pause_method == 'm25':
-                                        prepend_gcode += "M25 ; Pause\n"
-                                    elif pause_method == 'm0':
-                                        prepend_gcode += "M0 Press to Continue...\n"
-                                    # Retraction
-                                    prepend_gcode += "G1 E-%f F2400 ;Retract\n" % (retraction_mm)
-                                # Move the head back
-                                # X and Y first
-                                prepend_gcode += "G1 X%f Y%f F3000  ;Move to next layer position\n" % (x, y)
-                                # Then Z
-                                prepend_gcode += "G1 Z%f F3000  ;Move to next layer Z position\n" % (current_z)
-                                # Extrusion
-                                prepend_gcode += "G1 E%f F2400 ;Extrude\n" % (extrusion_mm)
-                                if extruder_absolute_mode:
-                                    prepend_gcode += "M82  ;Set extruder back to absolute mode\n"
-                                    prepend_gcode += "G92  E%f  ;Set the extrude value to the previous (before last retraction)\n" % (last_e)
-                                prepend_gcode += "M117 Printing...\n"
-                            prepend_gcode += ";CUSTOM Pause Done\n"
-                            
-                            beginning = lines[:line_index]
-                            ending = lines[line_index:]
-                            layer = "\n".join(beginning) + "\n" + prepend_gcode + "\n".join(ending) + "\n"
-                            
-                            data[data_index] = layer #Override the data of this layer with the modified data
-                            
-                            #We're done unless we come across another LAYER_COUNT value that signals another part
-                            ready = False
-                            continue
-                        # Continue to the next line
+                # If we have a height, and we're at least at the first layer, and we're moving, then it's time to see if we should pause
+                if pending and current_layer > 0 and current_z is not None and x is not None and y is not None:
+                    # If the current height >= where they want to pause, then we want to pause before we do the next move
+                    # Every pause that is due goes in front of this move, in the order they were scheduled
+                    due = [pause for pause in pending if pause.isDue(current_layer, current_z)]
+                    if due:
+                        for pause in due:
+                            prepend_gcode = self.getPauseGcode(pause.method, current_z, x, y, last_e, last_e_temp if pause.temperature is None else pause.temperature, extruder_absolute_mode, position_absolute_mode)
+                            # Remember where it goes, it gets spliced in once we're done with the layer
+                            insertions.append((line_index, prepend_gcode))
+                            pending.remove(pause)
+                        
+                        #We're done with those unless we come across another LAYER_COUNT value that signals another part
+                        continue
+                    # Continue to the next line
+                    continue
+        
+        state.pending = pending
+        state.last_e = last_e
+        state.last_e_age = last_e_age
+        state.last_e_temp = last_e_temp
+        state.extruder_absolute_mode = extruder_absolute_mode
+        state.position_absolute_mode = position_absolute_mode
+        state.current_layer = current_layer
+        state.currently_in_custom = currently_in_custom
+        self.stats.count("custom_lines_skipped", custom_lines)
+        return insertions
+    
+    #   The layer cache, if it's on and we have somewhere to put it
+    def getLayerCache(self):
+        if sqlite3 is None or not self.getSettingValueByKey("cache_layers"):
+            return None
+        path = self.layer_cache_path
+        if path is None and Resources is not None:
+            path = os.path.join(Resources.getCacheStoragePath(), "ChangeAtHeight", "layer_cache.sqlite")
+        if path is None:
+            return None
+        try:
+            return LayerCache(path, self.layer_cache_size)
+        except (OSError, sqlite3.Error):
+            # Never let the cache stop the pauses from being placed
+            return None
+    
+    #   The pauses to place, from the settings
+    def getPauses(self):
+        # Get the user values into variables
+        pause_type = self.getSettingValueByKey("pause_type")
+        pause_method = self.getSettingValueByKey("pause_method")
+        pause_z = self.getSettingValueByKey("pause_height")
+        pause_layer = self.getSettingValueByKey("pause_layer")
+        # 0 is the last temperature set in the g-code
+        resume_temperature = self.getSettingValueByKey("resume_temperature") or None
+        # Everything is handled as a schedule, a single pause is just a schedule with one entry
+        if pause_type == 'schedule':
+            get_temperature = None if self.material_library is None else self.material_library.getTemperature
+            pauses = parsePauseSchedule(self.getSettingValueByKey("pause_schedule"), pause_method, get_temperature)
+            for pause in pauses:
+                if pause.temperature is None:
+                    pause.temperature = resume_temperature
+        elif pause_type == 'height':
+            pauses = [PauseRequest('height', pause_z, pause_method, resume_temperature)]
+        else:
+            return [PauseRequest('layer', pause_layer, pause_method, resume_temperature)]
+        # Heights that can be worked out as layers are placed the same way as pauses at a layer, without looking at the Z of the moves
+        if self.getSettingValueByKey("pause_height_as_layer"):
+            layer_heights = self.getLayerHeights()
+            if layer_heights is not None:
+                for pause in pauses:
+                    if pause.pause_type == 'height':
+                        pause.pause_type = 'layer'
+                        pause.value = layer_heights.getLayerNumber(pause.value)
+        return pauses
+    
+    #   Place the pauses in the layers, yielding every layer once it's done.
+    #   layers can be any iterable of layer strings. They are handled one at a time, so a file can be streamed through without ever having all of it in memory.
+    #   Only a list is held on to for catchUp, the state follows the layers of anything else as they go by.
+    #   summaries can give the summary of every layer (None where it has to be scanned), in step with layers, when they have been made elsewhere, eg. in parallel by change_at_height_batch.py
+    def processLayers(self, layers, pauses, summaries = None):
+        if summaries is not None:
+            summaries = iter(summaries)
+        state = self.startRun(use_layer_cache = summaries is None)
+        stats = self.stats
+        profiler = self.profiler
+        # The layers passed on untouched since the state was last known, as (layer, start, end) for catchUp.
+        # Those of a list are still in the list anyway, but keeping the layers of an iterator would keep the rest of the file in memory, so those are followed as they go by instead
+        keep_layers = isinstance(layers, list)
+        fast_forwarded = []
+        layer_count = 0
+        try:
+            # Iterate through all the layers
+            # Keep track of where we are, so inserting doesn't have to search for the layer or line (which also finds the wrong one when lines repeat)
+            for data_index, layer in enumerate(layers):
+                layer_count = data_index + 1
+                if profiler is not None:
+                    profiler.enable()
+                summary = next(summaries) if summaries is not None else None
+                # Once all pauses are placed, only another print sequence can bring more, so until there's a LAYER_COUNT the layers are passed on untouched
+                if keep_layers and not state.pending:
+                    if ";LAYER_COUNT:" not in layer:
+                        fast_forwarded.append((layer, 0, None))
+                        stats.count("layers_fast_forwarded")
+                        if profiler is not None:
+                            profiler.disable()
+                        yield layer
                         continue
+                    self.catchUp(state, fast_forwarded, pauses)
+                # Layers where none of the pauses can happen are skipped over using their summary
+                if state.currently_in_custom:
+                    summary = None
+                elif summaries is None:
+                    with stats.phase("summarize"):
+                        summary = self.getLayerSummary(layer)
+                if summary is not None and not summary.mayPause(state):
+                    with stats.phase("track"):
+                        summary.apply(state)
+                else:
+                    with stats.phase("parse"):
+                        lines = layer.split("\n")
+                    with stats.phase("scan"):
+                        insertions = self.scanLayer(lines, state, pauses)
+                    stats.countScan(len(lines), layer)
+                    if insertions:
+                        with stats.phase("splice"):
+                            layer = spliceLines(lines, insertions)
+                        stats.countSplice(len(insertions), layer)
+                if profiler is not None:
+                    profiler.disable()
+                yield layer
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.finishRun(layer_count)
+    
+    #   Same as processLayers, for a g-code file in a bytes-like buffer like an mmap, with layer_bounds giving the (start, end) of every layer in it.
+    #   Layers are summarized straight from the buffer, and only the ones where a pause can happen are decoded and split into lines.
+    #   Yields every layer as a memoryview, of the buffer itself unless a pause was placed in it, so the file can be written out without copying it.
+    #   Release each one once it's written, the buffer can't be closed while there are any left.
+    def processBuffer(self, buffer, layer_bounds, pauses):
+        state = self.startRun()
+        stats = self.stats
+        profiler = self.profiler
+        fast_forwarded = []
+        layer_count = 0
+        view = memoryview(buffer)
+        try:
+            for data_index, (start, end) in enumerate(layer_bounds):
+                layer_count = data_index + 1
+                if profiler is not None:
+                    profiler.enable()
+                if not state.pending:
+                    if buffer.find(BYTES_PATTERNS.layer_count, start, end) == -1:
+                        fast_forwarded.append((buffer, start, end))
+                        stats.count("layers_fast_forwarded")
+                        if profiler is not None:
+                            profiler.disable()
+                        yield view[start:end]
+                        continue
+                    self.catchUp(state, fast_forwarded, pauses)
+                summary = None
+                if not state.currently_in_custom:
+                    with stats.phase("summarize"):
+                        summary = self.getLayerSummary(buffer, start, end)
+                if summary is not None and not summary.mayPause(state):
+                    with stats.phase("track"):
+                        summary.apply(state)
+                    layer = view[start:end]
+                else:
+                    with stats.phase("parse"):
+                        lines = buffer[start:end].decode("utf-8", "surrogateescape").split("\n")
+                    with stats.phase("scan"):
+                        insertions = self.scanLayer(lines, state, pauses)
+                    stats.countScan(len(lines), view[start:end])
+                    if insertions:
+                        with stats.phase("splice"):
+                            layer = memoryview(spliceLines(lines, insertions).encode("utf-8", "surrogateescape"))
+                        stats.countSplice(len(insertions), layer)
+                    else:
+                        layer = view[start:end]
+                if profiler is not None:
+                    profiler.disable()
+                yield layer
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.finishRun(layer_count)
+            view.release()
+    
+    #   The start of a run in a fused chain of scripts (see post_processing_chain.py), which calls visitLayer for every layer and finishChain at the end
+    def startChain(self):
+        self.chain_pauses = self.getPauses()
+        self.chain_state = self.startRun()
+        self.chain_fast_forwarded = []
+        self.chain_layers_fast_forwarded = 0
+        self.chain_layer_count = 0
+    
+    #   Same as a step of processLayers, for a layer of a fused chain. The pauses are recorded in the layer's shared edits instead of splicing the layer
+    def visitLayer(self, layer):
+        state = self.chain_state
+        stats = self.stats
+        self.chain_layer_count = layer.index + 1
+        # Only fast forward when the chain runs over a list, which holds on to the layers anyway
+        if layer.data is not None and not state.pending:
+            if ";LAYER_COUNT:" not in layer.text:
+                self.chain_fast_forwarded.append((layer.text, 0, None))
+                self.chain_layers_fast_forwarded += 1
+                return
+            self.catchUp(state, self.chain_fast_forwarded, self.chain_pauses)
+        summary = None
+        if not state.currently_in_custom:
+            with stats.phase("summarize"):
+                summary = self.getLayerSummary(layer.text)
+        if summary is not None and not summary.mayPause(state):
+            with stats.phase("track"):
+                summary.apply(state)
+        else:
+            with stats.phase("parse"):
+                lines = layer.lines
+            with stats.phase("scan"):
+                insertions = self.scanLayer(lines, state, self.chain_pauses, layer.getCommand)
+            # The chain splits and joins the layer once for all of its scripts, so nothing is copied for this one
+            stats.countScan(len(lines), b"")
+            for line_index, gcode in insertions:
+                layer.edits.insertBefore(line_index, gcode)
+            if insertions:
+                # Made again on its own, the layer would get a newline at the end, see spliceLines
+                layer.edits.addEnding("\n")
+            stats.countSplice(len(insertions), b"")
+    
+    #   The end of a fused chain. Returns the performance report comment for the end of the last layer, the same one execute() adds, if it's on
+    def finishChain(self):
+        self.stats.count("layers_fast_forwarded", self.chain_layers_fast_forwarded)
+        self.finishRun(self.chain_layer_count)
+        if self.stats.enabled and self.chain_layer_count:
+            return self.stats.getSummaryComment()
+        return None
+    
+    #   Bring state up to date over the fast_forwarded layers, (layer, start, end) with layer a string or buffer, now that a new print sequence needs it.
+    #   None of the pauses can happen in them, so this only follows the state. It's only needed for prints with more than one sequence (One at a Time)
+    def catchUp(self, state, fast_forwarded, pauses):
+        stats = self.stats
+        for layer, start, end in fast_forwarded:
+            summary = None if state.currently_in_custom else self.getLayerSummary(layer, start, end)
+            if summary is not None:
+                summary.apply(state)
+            else:
+                text = layer[start:end]
+                if not isinstance(text, str):
+                    text = text.decode("utf-8", "surrogateescape")
+                self.scanLayer(text.split("\n"), state, pauses)
+        stats.count("layers_caught_up", len(fast_forwarded))
+        del fast_forwarded[:]
+    
+    #   Get ready for a run over the layers, returning the state of the print at the start
+    def startRun(self, use_layer_cache = True):
+        self.pause_settings = None
+        self.layer_cache = self.getLayerCache() if use_layer_cache else None
+        self.stats = RunStats() if self.getSettingValueByKey("performance_report") else NULL_STATS
+        return PrintState()
+    
+    #   Done with a run over layer_count layers: close the layer cache and write the performance report, if they're on
+    def finishRun(self, layer_count):
+        if self.layer_cache is not None:
+            self.stats.count("cache_hits", self.layer_cache.hits)
+            self.stats.count("cache_misses", self.layer_cache.misses)
+        self.closeLayerCache()
+        if self.stats.enabled:
+            self.stats.finish(layer_count)
+            path = self.report_path
+            if path is None and Resources is not None:
+                path = os.path.join(Resources.getCacheStoragePath(), "ChangeAtHeight", "report.json")
+            if path is not None:
+                self.stats.writeReport(path)
+    
+    def closeLayerCache(self):
+        if self.layer_cache is not None:
+            try:
+                self.layer_cache.close()
+            except sqlite3.Error:
+                pass
+    
+    #   summarizeLayer, going through the layer cache when it's on
+    def getLayerSummary(self, layer, start = 0, end = None):
+        self.stats.count("summaries")
+        if self.layer_cache is None or not self.layer_cache.enabled:
+            return summarizeLayer(layer, start, end)
+        key = self.layer_cache.getKey(layer, start, end)
+        summary = self.layer_cache.get(key)
+        if summary is None:
+            summary = summarizeLayer(layer, start, end)
+            if summary is not None:
+                self.layer_cache.put(key, summary)
+        return summary
+    
+    def execute(self, data):
+        # Override the data of every layer with the modified data
+        data[:] = self.processLayers(data, self.getPauses())
+        if self.stats.enabled and data:
+            data[-1] += self.stats.getSummaryComment()
         
         # Return the data
         return data
@@ -0,0 +1,145 @@
+# Batch version of change_at_height_cli.py, to run the ChangeAtHeight script over many g-code files at once, eg. to regenerate every print in a repository after the park position or pause method changed.
+# The files of a directory tree are handled by a pool of worker processes, one file per worker. A single file is handled the same way as change_at_height_cli.py does,
+# unless --jobs is given: then it's split into chunks of layers, the workers summarize the chunks in parallel (see summarizeChunk), and the pauses are placed in one pass
+# that steps over the summaries. That only pays off for big files on a machine with cores to spare, the memory-mapped file of the single process is hard to beat.
+# Every file is written next to its output and moved in place when it's complete, so a failed or interrupted run never leaves half a file.
+#   python change_at_height_batch.py prints/ --output-dir paused/ --jobs 8 --pause-layer 12 --machine-profile wanhao_i3_settings.inst.cfg
+#   python change_at_height_batch.py big.gcode -o paused.gcode --pause-layer 12 --machine-width 200 --machine-depth 200 --machine-height 180
+
+import argparse
+import collections
+import concurrent.futures
+import fnmatch
+import itertools
+import os
+import sys
+import time
+
+from ChangeAtHeight import ChangeAtHeight, LayerSummary, summarizeLayer
+from change_at_height_cli import addMachineArguments, addSettingArguments, configureScript, processFile, readLayers, withSummaryComment, writeLayers
+
+# The files that are handled when a directory is given
+DEFAULT_PATTERNS = ("*.gcode", "*.gco", "*.g")
+# Layers per chunk when a single file is split up. Big enough that sending a chunk to a worker is cheap next to summarizing it
+CHUNK_LAYERS = 20
+
+#   Summaries of a chunk of layers, as plain values so they are cheap to send back from the worker process
+def summarizeChunk(layers):
+    summaries = []
+    for layer in layers:
+        summary = summarizeLayer(layer)
+        summaries.append(None if summary is None else summary.toJson())
+    return summaries
+
+#   Yield the layers, and add their summaries to the summaries deque before each chunk of them is yielded.
+#   The chunks are summarized in the executor, with only lookahead of them in flight at once, so a file is still streamed through.
+def summarizeInParallel(executor, layers, summaries, chunk_layers, lookahead):
+    layers = iter(layers)
+    in_flight = collections.deque()
+    while True:
+        while len(in_flight) < lookahead:
+            chunk = list(itertools.islice(layers, chunk_layers))
+            if not chunk:
+                break
+            in_flight.append((chunk, executor.submit(summarizeChunk, chunk)))
+        if not in_flight:
+            return
+        chunk, future = in_flight.popleft()
+        summaries.extend(None if values is None else LayerSummary.fromJson(values) for values in future.result())
+        yield from chunk
+
+#   Take the summaries out of the deque as processLayers needs them
+def popSummaries(summaries):
+    while True:
+        yield summaries.popleft()
+
+#   processFile, with the layers summarized by the workers of executor
+def processFileInParallel(script, executor, input_path, output_path, jobs, chunk_layers = CHUNK_LAYERS):
+    summaries = collections.deque()
+    layers = summarizeInParallel(executor, readLayers(input_path), summaries, chunk_layers, jobs * 2)
+    writeLayers(withSummaryComment(script, script.processLayers(layers, script.getPauses(), popSummaries(summaries))), output_path)
+
+#   processFile in a worker process, returning how long it took
+def timeProcessFile(script, input_path, output_path):
+    start = time.perf_counter()
+    output_directory = os.path.dirname(output_path)
+    if output_directory:
+        os.makedirs(output_directory, exist_ok = True)
+    processFile(script, input_path, output_path)
+    return time.perf_counter() - start
+
+#   The files under root that match one of the patterns, relative to root and in a fixed order
+def findFiles(root, patterns):
+    found = []
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        for name in sorted(files):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                found.append(os.path.relpath(os.path.join(directory, name), root))
+    return found
+
+def printTiming(seconds, path):
+    size = os.path.getsize(path) / 1e6
+    print("%8.2fs %8.1f MB/s  %s" % (seconds, size / seconds if seconds > 0 else 0, path))
+
+#   Run the script over every matching file under input_root, writing the results to the same place under output_root.
+#   Returns the number of files that failed, every other file is still done.
+def processTree(script, input_root, output_root, patterns, jobs):
+    files = findFiles(input_root, patterns)
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = {}
+        for path in files:
+            future = executor.submit(timeProcessFile, script, os.path.join(input_root, path), os.path.join(output_root, path))
+            futures[future] = path
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                # Whatever went wrong with one file (or its worker, or a layer cache shared with the other workers) mustn't stop the others
+                print("change_at_height_batch: %s: %s" % (path, e), file = sys.stderr)
+                failed += 1
+                continue
+            printTiming(seconds, os.path.join(output_root, path))
+    print("%d files in %.2fs, %d failed" % (len(files), time.perf_counter() - start, failed))
+    return failed
+
+def main(argv = None):
+    script = ChangeAtHeight()
+    parser = argparse.ArgumentParser(description = "Change filament or pause at a given height in many sliced g-code files, or one big one, using several processes.")
+    parser.add_argument("input", help = "A directory to handle every g-code file in, or a single g-code file.")
+    parser.add_argument("-o", "--output", help = "Where to write the result for a single file. Defaults to changing the input file in place.")
+    parser.add_argument("--output-dir", help = "Where to write the results for a directory, in the same layout. Defaults to changing the files in place.")
+    parser.add_argument("-j", "--jobs", type = int, help = "Number of worker processes (default %d for a directory, 1 for a single file)." % (os.cpu_count() or 1))
+    parser.add_argument("--chunk-layers", type = int, default = CHUNK_LAYERS, help = "Layers per chunk when a single file is split over the workers (default %(default)s).")
+    parser.add_argument("--pattern", action = "append", help = "Only handle files matching this pattern in a directory. Can be given more than once (default %s)." % ", ".join(DEFAULT_PATTERNS))
+    addMachineArguments(parser)
+    addSettingArguments(parser, script)
+    args = parser.parse_args(argv)
+    if (args.jobs is not None and args.jobs < 1) or args.chunk_layers < 1:
+        parser.error("--jobs and --chunk-layers must be at least 1")
+    configureScript(parser, args, script)
+
+    if os.path.isdir(args.input):
+        failed = processTree(script, args.input, args.output_dir or args.input, args.pattern or DEFAULT_PATTERNS, args.jobs or os.cpu_count() or 1)
+        return 1 if failed else 0
+
+    output_path = args.output or args.input
+    start = time.perf_counter()
+    try:
+        if args.jobs is None or args.jobs == 1:
+            processFile(script, args.input, output_path)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs) as executor:
+                processFileInParallel(script, executor, args.input, output_path, args.jobs, args.chunk_layers)
+    except (OSError, ValueError) as e:
+        print("change_at_height_batch: %s" % e, file = sys.stderr)
+        return 1
+    if output_path != "-":
+        printTiming(time.perf_counter() - start, output_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# Benchmark for the ChangeAtHeight script.
+# Runs execute() over generated prints (see synthetic_gcode.py) for a set of pause configurations and reports lines/sec, MB/sec and peak memory for each.
+# Results can be saved as a baseline, and later runs compared against it to catch slowdowns:
+#   python change_at_height_benchmark.py --save baseline.json
+#   python change_at_height_benchmark.py --compare baseline.json --tolerance 0.2
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from ChangeAtHeight import ChangeAtHeight
+from synthetic_gcode import generateGcode
+
+MACHINE_SETTINGS = {"machine_width": 200, "machine_depth": 200, "machine_height": 180}
+
+# The kinds of prints to run over, as options for generateGcode
+WORKLOADS = {
+    "absolute": {},
+    "relative": {"relative_extrusion": True},
+    "one_at_a_time": {"sequences": 3},
+    "g92_resets": {"g92_every": 10},
+    "custom_blocks": {"custom_every": 7},
+}
+
+#   The pause configurations, as script settings. They depend on the number of layers, so the pauses land at the bottom, middle and top of the print.
+def getConfigurations(layers, layer_height, first_layer_height):
+    middle = max(layers // 2, 1)
+    schedule = ", ".join(str(max(layers * i // 7, 1)) for i in range(1, 7))
+    return {
+        "layer_bottom": {"pause_type": "layer", "pause_layer": 2},
+        "layer_middle": {"pause_type": "layer", "pause_layer": middle},
+        "layer_top": {"pause_type": "layer", "pause_layer": layers},
+        "height_middle": {"pause_type": "height", "pause_height": first_layer_height + (middle - 1) * layer_height},
+        "m600_middle": {"pause_type": "layer", "pause_layer": middle, "pause_method": "m600"},
+        "schedule_6": {"pause_type": "schedule", "pause_schedule": schedule},
+        "never": {"pause_type": "layer", "pause_layer": layers + 100},
+    }
+
+#   Run the script once over a copy of data, returning the time it took
+def runOnce(settings, data):
+    script = ChangeAtHeight()
+    script.settings.update(settings)
+    script.machine_settings = MACHINE_SETTINGS
+    layers = list(data)
+    start = time.perf_counter()
+    script.execute(layers)
+    return time.perf_counter() - start
+
+#   Peak memory of one run, measured separately because tracing slows the run down
+def measurePeakMemory(settings, data):
+    tracemalloc.start()
+    try:
+        runOnce(settings, data)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def runBenchmarks(layers, lines_per_layer, repeat, workloads = None, configurations = None, seed = 0):
+    results = {}
+    layer_height = 0.2
+    first_layer_height = 0.3
+    all_configurations = getConfigurations(layers, layer_height, first_layer_height)
+    for workload_name, options in WORKLOADS.items():
+        if workloads and workload_name not in workloads:
+            continue
+        data = generateGcode(layers = layers, lines_per_layer = lines_per_layer, layer_height = layer_height, first_layer_height = first_layer_height, seed = seed, **options)
+        line_count = sum(layer.count("\n") for layer in data)
+        size = sum(len(layer) for layer in data)
+        for configuration_name, settings in all_configurations.items():
+            if configurations and configuration_name not in configurations:
+                continue
+            # Best of a few runs, the least disturbed by whatever else the machine is doing
+            elapsed = min(runOnce(settings, data) for _ in range(repeat))
+            results[workload_name + "/" + configuration_name] = {
+                "lines": line_count,
+                "bytes": size,
+                "seconds": elapsed,
+                "lines_per_second": line_count / elapsed,
+                "mb_per_second": size / elapsed / 1e6,
+                "peak_kb": measurePeakMemory(settings, data) / 1024,
+            }
+    return results
+
+def printResults(results, baseline = None):
+    print("%-30s %12s %10s %12s %10s" % ("benchmark", "lines/s", "MB/s", "peak memory", "vs base"))
+    for name, result in results.items():
+        compared = ""
+        if baseline is not None and name in baseline:
+            compared = "%9.2fx" % (result["lines_per_second"] / baseline[name]["lines_per_second"])
+        print("%-30s %12.0f %10.2f %10.0fkB %10s" % (name, result["lines_per_second"], result["mb_per_second"], result["peak_kb"], compared))
+
+#   The benchmarks that got slower than the baseline by more than the tolerance (0.2 is 20% slower)
+def findRegressions(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline.items():
+        if name in results and results[name]["lines_per_second"] < base["lines_per_second"] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the ChangeAtHeight script on generated g-code.")
+    parser.add_argument("--layers", type = int, default = 200, help = "Layers per print sequence.")
+    parser.add_argument("--lines", type = int, default = 500, help = "Moves per layer.")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Runs per benchmark, the fastest one counts.")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workload", action = "append", choices = list(WORKLOADS), help = "Only run this workload. Can be given more than once.")
+    parser.add_argument("--configuration", action = "append", help = "Only run this pause configuration. Can be given more than once.")
+    parser.add_argument("--save", help = "Save the results as a baseline to this file.")
+    parser.add_argument("--compare", help = "Compare against the baseline in this file, and fail if anything got slower than the tolerance.")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "How much slower than the baseline a benchmark may be, 0.2 is 20%% (default).")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        # Numbers are only comparable for the same prints
+        if saved["options"] != {"layers": args.layers, "lines": args.lines, "seed": args.seed}:
+            parser.error("the baseline was made with %s, run with the same --layers, --lines and --seed" % saved["options"])
+        baseline = saved["results"]
+
+    results = runBenchmarks(args.layers, args.lines, args.repeat, args.workload, args.configuration, args.seed)
+    printResults(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"options": {"layers": args.layers, "lines": args.lines, "seed": args.seed}, "results": results}, f, indent = 2, sort_keys = True)
+    if baseline is not None:
+        regressions = findRegressions(results, baseline, args.tolerance)
+        if regressions:
+            print("Slower than the baseline by more than %d%%: %s" % (args.tolerance * 100, ", ".join(regressions)), file = sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
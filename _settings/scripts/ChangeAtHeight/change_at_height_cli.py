@@ -0,0 +1,238 @@
+# Command line version of the ChangeAtHeight script, for g-code that has already been sliced.
+# It streams the file from disk to disk one layer at a time, so it doesn't need Cura and memory use doesn't grow with the size of the file.
+# Layers are read as bytes straight from the memory-mapped file, and the ones without a pause are written back out from there as they are.
+#
+# Every setting of the script is an option, eg. --pause-layer 12 or --head-park-x 20. The machine size comes from the options or from a Cura machine settings file:
+#   python change_at_height_cli.py print.gcode -o paused.gcode --pause-type layer --pause-layer 12 --machine-width 200 --machine-depth 200 --machine-height 180
+#   python change_at_height_cli.py print.gcode --pause-type schedule --pause-schedule "5, 12.5mm:m600" --machine-profile wanhao_i3_settings.inst.cfg
+# With --cache-layers true, the layers are remembered between runs (see LayerCache), which makes running again after slicing with small changes faster.
+# With --pause-height-as-layer true, pause heights are turned into layers from the layer heights in a Cura profile, given with --print-profile (see cura_profile.py).
+# Material names in the pause schedule, or --resume-material, heat back up to the temperature from the Cura material profiles (see material_library.py).
+# To find out where the time goes, --report report.json writes counters and phase timings (see RunStats), and --profile run.prof writes cProfile stats of the script.
+
+import argparse
+import configparser
+import cProfile
+import json
+import mmap
+import os
+import sys
+import tempfile
+
+import ChangeAtHeight as change_at_height
+from ChangeAtHeight import ChangeAtHeight
+from cura_profile import readPrintSettings
+from material_library import DEFAULT_CACHE as DEFAULT_MATERIAL_CACHE, DEFAULT_DIRECTORY as DEFAULT_MATERIAL_DIRECTORY, MachineMaterials
+
+# The machine settings the pauses need, to keep the print head inside the printer
+MACHINE_KEYS = ("machine_width", "machine_depth", "machine_height")
+
+# Where a layer starts, the same place Cura starts a new entry in its list of layers
+LAYER_START = b"\n;LAYER:"
+# Pages of the input that have been handled are given back in steps of this size, where the platform allows it
+RELEASE_SIZE = 16 * 1024 * 1024
+MADV_DONTNEED = getattr(mmap, "MADV_DONTNEED", None)
+
+# Where the layer cache goes if --layer-cache isn't given
+DEFAULT_LAYER_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ChangeAtHeight", "layer_cache.sqlite")
+
+#   Yield the (start, end) of every layer in buffer, the layers being where Cura starts a new entry in its list of layers.
+#   Pages of the buffer before the layer that is being handled are released as it goes, so memory use doesn't grow with the size of the file.
+def findLayerBounds(buffer):
+    start = 0
+    released = 0
+    while True:
+        end = buffer.find(LAYER_START, start)
+        if end == -1:
+            break
+        # The newline stays with the layer it ends
+        end += 1
+        yield start, end
+        start = end
+        if MADV_DONTNEED is not None and start - released >= RELEASE_SIZE:
+            page_start = start - start % mmap.PAGESIZE
+            buffer.madvise(MADV_DONTNEED, released, page_start - released)
+            released = page_start
+    yield start, len(buffer)
+
+#   Memory-map a g-code file for reading, or return None if it's empty (which can't be mapped, and has no layers anyway)
+def mapFile(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except ValueError:
+        return None
+
+#   Yield the layers of a g-code file one at a time, as strings.
+#   The file is memory-mapped, so only the layer that is being handled gets copied out of it.
+def readLayers(path):
+    with open(path, "rb") as f:
+        buffer = mapFile(f)
+        if buffer is None:
+            return
+        with buffer:
+            for start, end in findLayerBounds(buffer):
+                yield buffer[start:end].decode("utf-8", "surrogateescape")
+
+#   Run the script over a g-code file, yielding the layers as memoryviews of the memory-mapped file where nothing was inserted (see ChangeAtHeight.processBuffer).
+#   Layers are never decoded to strings unless a pause goes in them.
+def processMappedFile(script, path):
+    with open(path, "rb") as f:
+        buffer = mapFile(f)
+        if buffer is None:
+            return
+        with buffer:
+            yield from withSummaryComment(script, script.processBuffer(buffer, findLayerBounds(buffer), script.getPauses()))
+
+#   The layers, followed by the performance report comment if it's on. The report is only complete once all layers are done
+def withSummaryComment(script, layers):
+    yield from layers
+    if script.stats.enabled:
+        yield script.stats.getSummaryComment()
+
+#   Write a layer, as a string or a memoryview. Memoryviews are released right after, so the file they are from can be closed.
+def writeLayer(f, layer):
+    if isinstance(layer, str):
+        f.write(layer.encode("utf-8", "surrogateescape"))
+    else:
+        with layer:
+            f.write(layer)
+
+#   Write layers to a file as they come in. "-" writes to stdout.
+#   The file is written next to the output and moved in place when it's complete, so the output can also be the input, and a failed run never leaves half a file.
+def writeLayers(layers, path):
+    if path == "-":
+        for layer in layers:
+            writeLayer(sys.stdout.buffer, layer)
+        sys.stdout.buffer.flush()
+        return
+    handle, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = ".tmp")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            for layer in layers:
+                writeLayer(f, layer)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+#   Read the machine size from a Cura machine settings file (the [values] section of a definition_changes .inst.cfg) or any ini file laid out the same way
+def readMachineProfile(path):
+    parser = configparser.ConfigParser(interpolation = None)
+    if not parser.read(path):
+        raise ValueError("Can't read machine profile %s" % path)
+    if not parser.has_section("values"):
+        raise ValueError("Machine profile %s has no [values] section" % path)
+    machine_settings = {}
+    for key in MACHINE_KEYS:
+        if parser.has_option("values", key):
+            machine_settings[key] = parser.getfloat("values", key)
+    return machine_settings
+
+def parseBool(value):
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise argparse.ArgumentTypeError("expected true or false, not '%s'" % value)
+
+#   Options for all of the script's settings, made from its setting definitions so they can't get out of step
+def addSettingArguments(parser, script):
+    group = parser.add_argument_group("script settings", "The settings of the ChangeAtHeight script. Anything not given uses the script's default.")
+    for key, setting in json.loads(script.getSettingDataString())["settings"].items():
+        option = "--" + key.replace("_", "-")
+        if setting["type"] == "float":
+            group.add_argument(option, dest = key, type = float, help = setting["description"])
+        elif setting["type"] == "int":
+            group.add_argument(option, dest = key, type = int, help = setting["description"])
+        elif setting["type"] == "bool":
+            group.add_argument(option, dest = key, type = parseBool, metavar = "{true,false}", help = setting["description"])
+        elif setting["type"] == "enum":
+            group.add_argument(option, dest = key, choices = list(setting["options"]), help = setting["description"])
+        else:
+            group.add_argument(option, dest = key, help = setting["description"])
+
+#   Stream input_path through the script into output_path
+def processFile(script, input_path, output_path):
+    writeLayers(processMappedFile(script, input_path), output_path)
+
+#   Options for the machine size and the layer cache
+def addMachineArguments(parser):
+    machine = parser.add_argument_group("machine", "The size of the printer, used to keep the print head inside it. Options override the profile.")
+    machine.add_argument("--machine-profile", help = "Cura machine settings file with machine_width, machine_depth and machine_height in its [values] section.")
+    machine.add_argument("--machine-width", type = float)
+    machine.add_argument("--machine-depth", type = float)
+    machine.add_argument("--machine-height", type = float)
+    machine.add_argument("--print-profile", help = "Cura profile (.curaprofile) the g-code was sliced with, for the layer heights --pause-height-as-layer needs.")
+    cache = parser.add_argument_group("layer cache", "Only used with --cache-layers true.")
+    cache.add_argument("--layer-cache", default = DEFAULT_LAYER_CACHE, help = "The layer cache database (default %(default)s).")
+    cache.add_argument("--layer-cache-size", type = int, default = change_at_height.LAYER_CACHE_SIZE, help = "How many layers the cache remembers (default %(default)s).")
+    materials = parser.add_argument_group("materials", "The Cura material profiles used to look up material names in --pause-schedule (eg. 20:m0@hatchbox_pla_true_red) and --resume-material, see material_library.py.")
+    materials.add_argument("--resume-material", help = "Heat back up to the print temperature of this material after cooling down, instead of --resume-temperature.")
+    materials.add_argument("--material-machine", help = "Use the temperatures the material profiles give for this machine (product name, eg. \"IMADE3D JellyBOX\").")
+    materials.add_argument("--material-hotend", help = "Use the temperatures the material profiles give for this hotend of the machine (eg. \"0.4 mm\").")
+    materials.add_argument("--material-dir", default = DEFAULT_MATERIAL_DIRECTORY, help = "Where the material profiles are (default %(default)s).")
+    materials.add_argument("--material-cache", default = DEFAULT_MATERIAL_CACHE, help = "The index of the material profiles, so they're only read again when they change (default %(default)s).")
+
+#   Set up the script from the options made by addMachineArguments and addSettingArguments
+def configureScript(parser, args, script):
+    for key in script.settings:
+        if getattr(args, key) is not None:
+            script.settings[key] = getattr(args, key)
+
+    machine_settings = {}
+    if args.machine_profile:
+        try:
+            machine_settings = readMachineProfile(args.machine_profile)
+        except (ValueError, configparser.Error) as e:
+            parser.error(str(e))
+    for key in MACHINE_KEYS:
+        if getattr(args, key) is not None:
+            machine_settings[key] = getattr(args, key)
+    missing = [key for key in MACHINE_KEYS if key not in machine_settings]
+    if missing:
+        parser.error("the machine size is needed, give %s or a --machine-profile" % ", ".join("--" + key.replace("_", "-") for key in missing))
+    script.machine_settings = machine_settings
+    if args.print_profile:
+        try:
+            script.print_settings = readPrintSettings(args.print_profile)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    elif script.settings["pause_height_as_layer"]:
+        parser.error("--pause-height-as-layer needs the layer heights from a --print-profile")
+    script.layer_cache_path = args.layer_cache
+    script.layer_cache_size = args.layer_cache_size
+    script.material_library = MachineMaterials(args.material_machine, args.material_hotend, args.material_dir, args.material_cache)
+    if args.resume_material:
+        try:
+            script.settings["resume_temperature"] = script.material_library.getTemperature(args.resume_material)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+def main(argv = None):
+    script = ChangeAtHeight()
+    parser = argparse.ArgumentParser(description = "Change filament or pause at a given height in a sliced g-code file, without Cura.")
+    parser.add_argument("input", help = "The g-code file to add pauses to.")
+    parser.add_argument("-o", "--output", help = "Where to write the result, - for stdout. Defaults to changing the input file in place.")
+    parser.add_argument("--report", help = "Write counters and phase timings of the run to this JSON file, and a summary of them at the end of the g-code.")
+    parser.add_argument("--profile", help = "Profile the script with cProfile and write the stats to this file, to read with pstats.")
+    addMachineArguments(parser)
+    addSettingArguments(parser, script)
+    args = parser.parse_args(argv)
+    configureScript(parser, args, script)
+    if args.report:
+        script.settings["performance_report"] = True
+        script.report_path = args.report
+    if args.profile:
+        script.profiler = cProfile.Profile()
+
+    try:
+        processFile(script, args.input, args.output or args.input)
+        if script.profiler is not None:
+            script.profiler.dump_stats(args.profile)
+    except (OSError, ValueError) as e:
+        print("change_at_height_cli: %s" % e, file = sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,451 @@
+# Checks that every way of running the ChangeAtHeight script gives exactly the same g-code as the original script (legacy_change_at_height.py), and that they stay faster than it.
+# The candidates are the ways the script can run: execute(), in a fused chain, streamed, on the memory-mapped file, with summaries made elsewhere and with the layer cache.
+# The stacked candidate runs it twice in a fused chain with a script that changes lines, which has to give the same as running the three of them one after the other.
+# They are run on:
+# - generated prints (see synthetic_gcode.py), for every workload and pause configuration of the benchmark
+# - real g-code files, given with --corpus
+# - random cases: generated prints with tricky lines mixed in (G92s, mode changes, CUSTOM blocks, markers after code, odd numbers, ...), split into layers in odd ways,
+#   with random settings and machine sizes. The same --seed always gives the same cases
+# Any difference is reported with the first line that differs, and with --failures the case is written out to look at.
+#   python change_at_height_equivalence.py --fuzz 500 --corpus prints/ --failures failed/
+# With --performance, it also measures how much faster than the original every candidate is, and fails if one isn't at least --min-speedup times as fast.
+# Speedups are measured in the same run as the original, so they can be compared between machines. They can be saved and later runs checked against them:
+#   python change_at_height_equivalence.py --performance --save speedups.json
+#   python change_at_height_equivalence.py --performance --compare speedups.json --tolerance 0.2
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from ChangeAtHeight import ChangeAtHeight, LayerSummary
+from change_at_height_batch import CHUNK_LAYERS, findFiles, summarizeChunk
+from change_at_height_benchmark import WORKLOADS, getConfigurations
+from change_at_height_cli import processMappedFile, readLayers, writeLayers
+from legacy_change_at_height import LegacyChangeAtHeight
+from post_processing_chain import LineVisitor, PostProcessingChain
+from synthetic_gcode import generateGcode
+
+MACHINE_SETTINGS = {"machine_width": 200, "machine_depth": 200, "machine_height": 180}
+# Settings the original script has, the random cases pick from these
+PAUSE_METHODS = ("m25", "m0", "m600")
+CORPUS_PATTERNS = ("*.gcode", "*.gco", "*.g")
+
+# One print and the settings to run over it. The inputs and outputs that candidates share are made once
+class Case:
+    def __init__(self, name, data, settings, machine_settings, directory):
+        self.name = name
+        self.data = data
+        self.settings = settings
+        self.machine_settings = machine_settings
+        self.directory = directory
+        self.input_path = None
+        self.expected = {}
+
+    #   The print as a file, for the candidates that read one
+    def getInputPath(self):
+        if self.input_path is None:
+            self.input_path = os.path.join(self.directory, "input.gcode")
+            with open(self.input_path, "wb") as f:
+                for layer in self.data:
+                    f.write(layer.encode("utf-8", "surrogateescape"))
+        return self.input_path
+
+    #   The layers as the command line tools split the file, which isn't always where the list of layers was split
+    def getFileLayers(self):
+        return list(readLayers(self.getInputPath()))
+
+    #   The script with the settings of the case
+    def makeScript(self):
+        script = ChangeAtHeight()
+        script.settings.update(self.settings)
+        script.machine_settings = dict(self.machine_settings)
+        return script
+
+    #   What the original script makes of the layers as a list ("list"), as the file is split ("file"), or stacked with FanLimit ("stacked", see runStackedLegacy).
+    #   Where a pause goes in a layer depends on where the layer ends
+    def getExpected(self, kind = "list"):
+        if kind not in self.expected:
+            self.expected[kind] = runStackedLegacy(self) if kind == "stacked" else runLegacy(self, kind)
+        return self.expected[kind]
+
+# A script that changes lines without knowing about the others in a chain: it turns the fan down from full speed and drops the dwells (G4).
+# Neither is ever in a pause block, so it doesn't matter whether it sees the layers with the pauses in them or not
+class FanLimit(LineVisitor):
+    #   The line as it should be, or None to remove it
+    @staticmethod
+    def changeLine(line):
+        if line == "M106 S255":
+            return "M106 S204"
+        if line.startswith("G4 "):
+            return None
+        return line
+
+    def visitLine(self, layer, line_index, command):
+        line = layer.lines[line_index]
+        new_line = self.changeLine(line)
+        if new_line is None:
+            layer.edits.deleteLine(line_index)
+        elif new_line != line:
+            layer.edits.replaceLine(line_index, new_line)
+
+    #   The same on its own, the way a script does it when it isn't in a chain
+    def execute(self, data):
+        for data_index, layer in enumerate(data):
+            lines = [self.changeLine(line) for line in layer.split("\n")]
+            data[data_index] = "\n".join(line for line in lines if line is not None)
+        return data
+
+def makeLegacyScript(case):
+    return LegacyChangeAtHeight(dict(case.makeScript().settings), dict(case.machine_settings))
+
+def runLegacy(case, split = "list"):
+    data = list(case.data) if split == "list" else case.getFileLayers()
+    return "".join(makeLegacyScript(case).execute(data))
+
+#   The original script twice with the same settings, so both pause in the same layers, then FanLimit, one after the other
+def runStackedLegacy(case):
+    data = list(case.data)
+    for script in (makeLegacyScript(case), makeLegacyScript(case), FanLimit()):
+        data = script.execute(data)
+    return "".join(data)
+
+def runExecute(case):
+    return "".join(case.makeScript().execute(list(case.data)))
+
+def runChain(case):
+    return "".join(PostProcessingChain([case.makeScript()]).execute(list(case.data)))
+
+#   The layers coming from an iterator, like a file that is streamed through, so nothing can be read again once it's passed on
+def runStream(case):
+    script = case.makeScript()
+    return "".join(script.processLayers(iter(case.data), script.getPauses()))
+
+def runBuffer(case):
+    output_path = os.path.join(case.directory, "output.gcode")
+    writeLayers(processMappedFile(case.makeScript(), case.getInputPath()), output_path)
+    with open(output_path, "rb") as f:
+        return f.read().decode("utf-8", "surrogateescape")
+
+#   Summaries made the way change_at_height_batch.py makes them in its workers, and sent back as JSON
+def runParallelSummaries(case):
+    script = case.makeScript()
+    summaries = []
+    for start in range(0, len(case.data), CHUNK_LAYERS):
+        summaries.extend(None if values is None else LayerSummary.fromJson(values) for values in summarizeChunk(case.data[start:start + CHUNK_LAYERS]))
+    return "".join(script.processLayers(iter(case.data), script.getPauses(), summaries))
+
+#   The same as runStackedLegacy, in one fused chain
+def runStacked(case):
+    return "".join(PostProcessingChain([case.makeScript(), case.makeScript(), FanLimit()]).execute(list(case.data)))
+
+#   Spoil every summary in the layer cache, in turns with something that isn't JSON and with JSON that isn't a summary
+def spoilLayerCache(cache_path):
+    connection = sqlite3.connect(cache_path)
+    with connection:
+        connection.execute("UPDATE layers SET summary = CASE WHEN rowid % 2 THEN '[1, 2' ELSE '[1, 2]' END")
+    connection.close()
+
+#   A run with an empty layer cache, then one that gets every summary from it, then one where none of the summaries in it can be read.
+#   All of them have to be right, so a difference in the first one shows up as well
+def runLayerCache(case):
+    cache_path = os.path.join(case.directory, "layer_cache.sqlite")
+    if os.path.exists(cache_path):
+        os.unlink(cache_path)
+    outputs = []
+    for run in range(3):
+        if run == 2:
+            spoilLayerCache(cache_path)
+        script = case.makeScript()
+        script.settings["cache_layers"] = True
+        script.layer_cache_path = cache_path
+        outputs.append("".join(script.execute(list(case.data))))
+    for output in outputs[:-1]:
+        if output != outputs[-1]:
+            return output
+    return outputs[-1]
+
+# Name: (run the candidate, what it has to give, see Case.getExpected)
+CANDIDATES = {
+    "execute": (runExecute, "list"),
+    "chain": (runChain, "list"),
+    "stream": (runStream, "list"),
+    "buffer": (runBuffer, "file"),
+    "parallel_summaries": (runParallelSummaries, "list"),
+    "layer_cache": (runLayerCache, "list"),
+    "stacked": (runStacked, "stacked"),
+}
+
+#   Where two outputs first differ, as a message, or None when they are the same
+def describeDifference(expected, actual):
+    if expected == actual:
+        return None
+    expected_lines = expected.split("\n")
+    actual_lines = actual.split("\n")
+    for line_number, (expected_line, actual_line) in enumerate(zip(expected_lines, actual_lines), 1):
+        if expected_line != actual_line:
+            return "line %d: expected %r, got %r" % (line_number, expected_line, actual_line)
+    return "expected %d lines, got %d" % (len(expected_lines), len(actual_lines))
+
+#   The cases made from the generated prints of the benchmark, with every pause configuration the original script has
+def makeGeneratedCases(directory, layers = 30, lines_per_layer = 60):
+    layer_height = 0.2
+    first_layer_height = 0.3
+    configurations = getConfigurations(layers, layer_height, first_layer_height)
+    configurations["m0_no_cool_down"] = {"pause_type": "layer", "pause_layer": layers // 3, "pause_method": "m0", "cool_down": False}
+    configurations["m25_no_change"] = {"pause_type": "height", "pause_height": 2.1, "change_filament": False, "beep": False}
+    configurations["park_outside"] = {"pause_type": "layer", "pause_layer": 3, "head_park_x": 500, "head_park_y": -5, "head_move_z": -1, "min_head_park_z": 0}
+    for workload_name, options in WORKLOADS.items():
+        data = generateGcode(layers = layers, lines_per_layer = lines_per_layer, layer_height = layer_height, first_layer_height = first_layer_height, **options)
+        for configuration_name, settings in configurations.items():
+            # The original only pauses at a height or a layer
+            if settings["pause_type"] in ("height", "layer"):
+                yield Case("generated/%s/%s" % (workload_name, configuration_name), data, settings, MACHINE_SETTINGS, directory)
+
+#   The cases made from real g-code files, split into layers the way Cura splits them
+def makeCorpusCases(paths, directory):
+    for path in paths:
+        files = [os.path.join(path, name) for name in findFiles(path, CORPUS_PATTERNS)] if os.path.isdir(path) else [path]
+        for file_path in files:
+            data = list(readLayers(file_path))
+            layers = sum(layer.count(";LAYER:") for layer in data)
+            configurations = [{"pause_type": "layer", "pause_layer": max(layer, 1)} for layer in (1, layers // 3, layers // 2, layers)]
+            configurations += [{"pause_type": "height", "pause_height": height} for height in (0.2, 1., 5., 25.)]
+            configurations += [{"pause_type": "layer", "pause_layer": max(layers // 2, 1), "pause_method": method} for method in ("m0", "m600")]
+            for index, settings in enumerate(configurations):
+                yield Case("corpus/%s/%d" % (file_path, index), data, settings, MACHINE_SETTINGS, directory)
+
+#   Lines that hit the corners of the original's parsing and state tracking
+def makeTrickyLine(rnd, z):
+    x = rnd.uniform(-10, 250)
+    y = rnd.uniform(-10, 250)
+    return rnd.choice((
+        "G92", "G92 E0", "G92 E%.3f" % rnd.uniform(-5, 500), "G92 X0 Y0", "G92 Z%.2f" % z, "G92 E",
+        "M82", "M83", "G90", "G91", "M82 ;absolute", "M83 ; relative E5",
+        "M104 S%d" % rnd.randint(0, 300), "M109 S%.1f" % rnd.uniform(150, 260), "M104 ;S300", "M104 T1 S%d" % rnd.randint(150, 260), "M109 R200", "M104 S",
+        ";TYPE:CUSTOM", ";CUSTOM", "G1 X%.2f ;TYPE:CUSTOM" % x, "M117 ;CUSTOM done", ";TYPE:CUSTOMER",
+        ";LAYER:%d" % rnd.randint(-3, 50), ";LAYER:", ";LAYER:x", "G1 X%.1f Y%.1f ;LAYER:%d" % (x, y, rnd.randint(0, 9)), "; note ;LAYER:5", ";LAYER_COUNT:%d" % rnd.randint(1, 30),
+        "G1 E%.4f" % rnd.uniform(-10, 1000), "G1 E-%.3f F2400" % rnd.uniform(0, 6), "G1 F1200 E%.5f" % rnd.uniform(0, 50),
+        "G1 X%.2f Y%.2f Z%.2f" % (x, y, z), "G0 X%.2f Y%.2f Z%.2f E%.3f" % (x, y, z, rnd.uniform(0, 100)), "G1 Z%.2f X%.2f Y%.2f" % (z, x, y),
+        "G1 X.5 Y-.5 Z.%d" % rnd.randint(1, 9), "G1 X5 Y5 Z%d. E2." % rnd.randint(0, 20), "G1X%.1fY%.1fZ%.2fE%.2f" % (x, y, z, rnd.uniform(0, 99)),
+        "G1 X1 Y1 Z%.2f ; Z99 E99" % z, "G1 F1200 X10 Y10 Z%.2f" % z, "  G1 X%.1f Y%.1f Z%.2f" % (x, y, z), "G1 X%.1f Y%.1f Z-%.2f" % (x, y, z),
+        "G1 XY Z%.2f" % z, "G1 X Y Z", "G1 X%.1f X%.1f Y1 Z%.2f" % (x, y, z), "g1 x1 y1 z1", "G01 X%.1f Y%.1f Z%.2f" % (x, y, z), "G1.5 X1 Y1 Z%.2f" % z,
+        "M117 Ever E%d" % rnd.randint(0, 9), "M117 Z%d" % rnd.randint(0, 99), "M117 Heating Extruder", "T0", "T1", "M600", "G28 X0 Y0", "G4 P100",
+        "G1 X10 Y10", "G0 X%.1f Y%.1f" % (x, y), "; just a comment", ";", "", " ", "G1 E1e3", "G1 X1,5 Y2 Z%.2f" % z, "G1 X%.2f Y%.2f Z%.2f\r" % (x, y, z),
+    ))
+
+#   E values that go up and then down a few times, the way the original tells a high E value it should forget from a real one.
+#   What it ends up with depends on how many lower values there are, so these go right in front of where pauses are placed, and at the end of layers
+def makeERun(rnd):
+    base = rnd.uniform(0, 50)
+    run = ["G1 F2400 E%.5f" % (base + rnd.uniform(1, 500))]
+    for value in range(rnd.randint(1, 5)):
+        kind = rnd.random()
+        if kind < 0.6:
+            run.append("G1 X%.2f Y%.2f E%.5f" % (rnd.uniform(10, 190), rnd.uniform(10, 190), base - rnd.uniform(0, 5)))
+        elif kind < 0.75:
+            run.append(run[-1])
+        elif kind < 0.9:
+            run.append("G92 E%.2f" % rnd.uniform(0, 10))
+        else:
+            run.append("G92")
+    return run
+
+#   A generated print with tricky lines mixed in and split up differently, with random settings and a random machine
+def makeFuzzCase(rnd, index, directory):
+    layers = rnd.randint(1, 25)
+    layer_height = rnd.choice((0.1, 0.12, 0.2, 0.3))
+    first_layer_height = rnd.choice((0.2, 0.3))
+    data = generateGcode(layers = layers, lines_per_layer = rnd.randint(1, 40), sequences = rnd.randint(1, 3), relative_extrusion = rnd.random() < 0.3,
+        custom_every = rnd.choice((0, 0, 2, 5)), g92_every = rnd.choice((0, 0, 3, 7)), layer_height = layer_height, first_layer_height = first_layer_height, seed = rnd.randrange(1 << 30))
+    max_z = first_layer_height + layers * layer_height
+
+    # Tricky lines in some of the layers
+    for data_index in range(len(data)):
+        if rnd.random() < 0.4:
+            lines = data[data_index].split("\n")
+            for tricky in range(rnd.randint(1, 6)):
+                lines.insert(rnd.randint(0, len(lines)), makeTrickyLine(rnd, round(rnd.uniform(0, max_z + 1), 2)))
+            data[data_index] = "\n".join(lines)
+    # Runs of E values in front of the first move to a height, where a pause goes, or at the end of the layer
+    for data_index in range(len(data)):
+        if rnd.random() < 0.3:
+            lines = data[data_index].split("\n")
+            moves = [line_index for line_index, line in enumerate(lines) if " Z" in line and line.startswith("G")]
+            line_index = moves[0] if moves and rnd.random() < 0.6 else len(lines) - 1
+            lines[line_index:line_index] = makeERun(rnd)
+            data[data_index] = "\n".join(lines)
+    # Layers split, joined, repeated or left empty, which Cura doesn't do but other scripts before this one might
+    for change in range(rnd.randint(0, 4)):
+        data_index = rnd.randrange(len(data))
+        kind = rnd.random()
+        if kind < 0.25:
+            data.insert(data_index, data[data_index])
+        elif kind < 0.5 and data_index + 1 < len(data):
+            data[data_index:data_index + 2] = [data[data_index] + data[data_index + 1]]
+        elif kind < 0.75:
+            lines = data[data_index].split("\n")
+            split = rnd.randint(0, len(lines))
+            data[data_index:data_index + 1] = ["\n".join(lines[:split]) + "\n", "\n".join(lines[split:])]
+        else:
+            data.insert(data_index, rnd.choice(("", "\n", ";LAYER:0\n")))
+
+    settings = {
+        "pause_type": rnd.choice(("height", "layer")),
+        "pause_method": rnd.choice(PAUSE_METHODS),
+        "pause_height": round(rnd.uniform(-1, max_z + 2), rnd.randint(0, 3)),
+        "pause_layer": rnd.randint(1, layers + 3),
+        "change_filament": rnd.random() < 0.5,
+        "cool_down": rnd.random() < 0.5,
+        "beep": rnd.random() < 0.5,
+        "head_park_x": round(rnd.uniform(-20, 300), 2),
+        "head_park_y": round(rnd.uniform(-20, 300), 2),
+        "head_move_z": round(rnd.uniform(-5, 30), 2),
+        "min_head_park_z": round(rnd.uniform(0, 200), 2),
+        "retraction_mm": round(rnd.uniform(0, 10), 2),
+        "extrusion_mm": round(rnd.uniform(0, 10), 2),
+        "prime_mm": rnd.choice((0, round(rnd.uniform(-2, 10), 2))),
+    }
+    machine_settings = {"machine_width": rnd.randint(50, 300), "machine_depth": rnd.randint(50, 300), "machine_height": rnd.randint(20, 300)}
+    return Case("fuzz/%d" % index, data, settings, machine_settings, directory)
+
+#   Write a case that failed, to run it again or look at it
+def saveFailure(directory, case, candidate_name, expected, actual):
+    name = case.name.replace("/", "_").replace(os.sep, "_") + "." + candidate_name
+    with open(os.path.join(directory, name + ".json"), "w") as f:
+        json.dump({"settings": case.settings, "machine_settings": case.machine_settings, "layers": case.data}, f, indent = 1)
+    for suffix, text in (("expected", expected), ("actual", actual)):
+        with open(os.path.join(directory, "%s.%s.gcode" % (name, suffix)), "w", encoding = "utf-8", errors = "surrogateescape") as f:
+            f.write(text)
+
+#   Run every candidate on the case. Returns the number of candidates that didn't give the original's output
+def checkCase(case, candidates, failures_directory = None):
+    failed = 0
+    for candidate_name in candidates:
+        run, kind = CANDIDATES[candidate_name]
+        expected = case.getExpected(kind)
+        try:
+            actual = run(case)
+        except Exception as e:
+            actual = "%s: %s" % (type(e).__name__, e)
+        difference = describeDifference(expected, actual)
+        if difference is not None:
+            failed += 1
+            print("MISMATCH %s %s: %s" % (case.name, candidate_name, difference))
+            if failures_directory is not None:
+                saveFailure(failures_directory, case, candidate_name, expected, actual)
+    return failed
+
+#   The fastest of a few runs of the case, in seconds
+def timeRun(run, case, repeat):
+    best = None
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        run(case)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+#   How many times as fast as the original every candidate is, on the benchmark's prints with a pause in the middle.
+#   The time of a candidate is all of what it does: layer_cache is all three of its runs, buffer includes writing the output file. stacked is compared with runStackedLegacy
+def measureSpeedups(candidates, directory, layers, lines_per_layer, repeat):
+    results = {}
+    for workload_name, options in WORKLOADS.items():
+        data = generateGcode(layers = layers, lines_per_layer = lines_per_layer, **options)
+        case = Case("performance/" + workload_name, data, {"pause_type": "layer", "pause_layer": max(layers // 2, 1)}, MACHINE_SETTINGS, directory)
+        line_count = sum(layer.count("\n") for layer in data)
+        legacy_seconds = timeRun(runLegacy, case, repeat)
+        stacked_legacy_seconds = None
+        for candidate_name in candidates:
+            run, kind = CANDIDATES[candidate_name]
+            original_seconds = legacy_seconds
+            if kind == "stacked":
+                if stacked_legacy_seconds is None:
+                    stacked_legacy_seconds = timeRun(runStackedLegacy, case, repeat)
+                original_seconds = stacked_legacy_seconds
+            seconds = timeRun(run, case, repeat)
+            results[workload_name + "/" + candidate_name] = {
+                "speedup": original_seconds / seconds,
+                "lines_per_second": line_count / seconds,
+                "legacy_lines_per_second": line_count / original_seconds,
+            }
+    return results
+
+def printSpeedups(results, baseline = None):
+    print("%-40s %12s %12s %9s %10s" % ("candidate", "lines/s", "legacy", "speedup", "recorded"))
+    for name, result in results.items():
+        recorded = ""
+        if baseline is not None and name in baseline:
+            recorded = "%9.2fx" % baseline[name]["speedup"]
+        print("%-40s %12.0f %12.0f %8.2fx %10s" % (name, result["lines_per_second"], result["legacy_lines_per_second"], result["speedup"], recorded))
+
+#   The candidates that are too slow: less than min_speedup times as fast as the original, or slower than the recorded speedup by more than the tolerance (0.2 is 20%)
+def findSlowCandidates(results, min_speedup, baseline = None, tolerance = 0.2):
+    slow = []
+    for name, result in results.items():
+        if result["speedup"] < min_speedup:
+            slow.append(name)
+        elif baseline is not None and name in baseline and result["speedup"] < baseline[name]["speedup"] * (1 - tolerance):
+            slow.append(name)
+    return slow
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check that every way of running ChangeAtHeight gives the same g-code as the original script, and is faster than it.")
+    parser.add_argument("--candidate", action = "append", choices = list(CANDIDATES), help = "Only check this candidate. Can be given more than once.")
+    parser.add_argument("--corpus", action = "append", default = [], help = "A g-code file, or a directory of them, to check on as well. Can be given more than once.")
+    parser.add_argument("--fuzz", type = int, default = 200, help = "Number of random cases (default %(default)s).")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed for the random cases.")
+    parser.add_argument("--failures", help = "Write the cases that fail to this directory.")
+    performance = parser.add_argument_group("performance", "Only with --performance.")
+    performance.add_argument("--performance", action = "store_true", help = "Measure the speedup of every candidate over the original as well.")
+    performance.add_argument("--layers", type = int, default = 100, help = "Layers per print sequence of the prints to measure on.")
+    performance.add_argument("--lines", type = int, default = 300, help = "Moves per layer of the prints to measure on.")
+    performance.add_argument("--repeat", type = int, default = 3, help = "Runs per measurement, the fastest one counts.")
+    performance.add_argument("--min-speedup", type = float, default = 1., help = "Fail if a candidate is less than this many times as fast as the original (default %(default)s).")
+    performance.add_argument("--save", help = "Save the speedups to this file.")
+    performance.add_argument("--compare", help = "Fail if a speedup dropped below the one in this file by more than the tolerance.")
+    performance.add_argument("--tolerance", type = float, default = 0.2, help = "How much lower than the recorded one a speedup may be, 0.2 is 20%% (default).")
+    args = parser.parse_args(argv)
+    candidates = args.candidate or list(CANDIDATES)
+    if args.failures:
+        os.makedirs(args.failures, exist_ok = True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        # Speedups are only comparable for the same prints
+        if saved["options"] != {"layers": args.layers, "lines": args.lines}:
+            parser.error("the speedups were recorded with %s, run with the same --layers and --lines" % saved["options"])
+        baseline = saved["results"]
+
+    failed = 0
+    cases = 0
+    with tempfile.TemporaryDirectory() as directory:
+        rnd = random.Random(args.seed)
+        all_cases = [makeGeneratedCases(directory), makeCorpusCases(args.corpus, directory), (makeFuzzCase(rnd, index, directory) for index in range(args.fuzz))]
+        for case_group in all_cases:
+            for case in case_group:
+                failed += 1 if checkCase(case, candidates, args.failures) else 0
+                cases += 1
+        print("%d cases, %d with differences" % (cases, failed))
+
+        slow = []
+        if args.performance:
+            results = measureSpeedups(candidates, directory, args.layers, args.lines, args.repeat)
+            printSpeedups(results, baseline)
+            if args.save:
+                with open(args.save, "w") as f:
+                    json.dump({"options": {"layers": args.layers, "lines": args.lines}, "results": results}, f, indent = 2, sort_keys = True)
+            slow = findSlowCandidates(results, args.min_speedup, baseline, args.tolerance)
+            if slow:
+                print("Too slow: %s" % ", ".join(slow), file = sys.stderr)
+    return 1 if failed or slow else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# Reads the layer heights and raft settings out of a Cura profile export (*.curaprofile, eg. _settings/settings/draft_pla.curaprofile), without unpacking it.
+# A .curaprofile is a zip of Cura container files, one for the global stack and one per extruder, each an INI file with the changed settings in [values].
+# Only the members that have a setting we need are read: the global one first, the extruder ones only for what the global one doesn't set.
+# Settings the profile doesn't change are Cura's defaults (fdmprinter), so the result always has every key in PRINT_KEYS.
+# The result is remembered by the hash of the archive, so reading the same profile again for every file of a batch costs one hash.
+#   print_settings = readPrintSettings("draft_pla.curaprofile")
+#   print_settings["layer_height"], print_settings["adhesion_type"]
+# This is what ChangeAtHeight's print_settings are, to turn pause heights into layer numbers (see LayerHeights) when it runs without Cura.
+# cura_profile_check.py checks this and the layer numbers that come out of it.
+
+import configparser
+import hashlib
+import zipfile
+
+# The settings ChangeAtHeight's LayerHeights are made from, with the default Cura uses when a profile doesn't change them.
+# Defaults that are formulas in Cura are None here, and worked out in readPrintSettings
+PRINT_KEYS = {
+    "layer_height": 0.1,
+    "layer_height_0": 0.3,
+    "adhesion_type": "brim",
+    "raft_base_thickness": None,
+    "raft_interface_thickness": None,
+    "raft_interface_layers": 1,
+    "raft_surface_thickness": None,
+    "raft_surface_layers": 2,
+    "raft_airgap": 0.3,
+    "layer_0_z_overlap": None,
+    "adaptive_layer_height_enabled": False,
+}
+
+# readPrintSettings results by the hash of the archive
+PROFILE_CACHE = {}
+
+class CuraProfile:
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        # [values] of the members that have been read, by member name
+        self.values = {}
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #   The global stack's member first, then the extruders' in order. Extruder members have a position in their [metadata], which is only known once they're read,
+    #   but Cura names them after the extruder, so the name is enough to put them last
+    def getMemberNames(self):
+        return sorted(self.archive.namelist(), key = lambda name: ("_extruder_" in name, name))
+
+    #   The [values] of one member, read and parsed the first time it's needed
+    def getValues(self, name):
+        values = self.values.get(name)
+        if values is None:
+            parser = configparser.ConfigParser(interpolation = None)
+            try:
+                parser.read_string(self.archive.read(name).decode("utf-8"), name)
+            except (configparser.Error, UnicodeDecodeError) as e:
+                raise ValueError("Can't read %s in %s: %s" % (name, self.path, e))
+            values = self.values[name] = dict(parser.items("values")) if parser.has_section("values") else {}
+        return values
+
+    #   The value the profile sets for key, as a string, None if no member sets it.
+    #   Formulas (values starting with =) are Cura expressions that need the rest of Cura to work out, so they count as not set
+    def getValue(self, key):
+        for name in self.getMemberNames():
+            value = self.getValues(name).get(key)
+            if value is not None and not value.startswith("="):
+                return value
+        return None
+
+#   The PRINT_KEYS settings of the profile, with Cura's defaults for the ones it doesn't change
+def readPrintSettings(path):
+    with open(path, "rb") as f:
+        digest = hashlib.blake2b(f.read(), digest_size = 16).hexdigest()
+    print_settings = PROFILE_CACHE.get(digest)
+    if print_settings is not None:
+        return dict(print_settings)
+
+    try:
+        profile = CuraProfile(path)
+    except zipfile.BadZipFile as e:
+        raise ValueError("Can't read Cura profile %s: %s" % (path, e))
+    with profile:
+        print_settings = {}
+        for key, default in PRINT_KEYS.items():
+            value = profile.getValue(key)
+            if value is None:
+                print_settings[key] = default
+            elif isinstance(default, bool):
+                print_settings[key] = value.lower() == "true"
+            elif isinstance(default, str):
+                print_settings[key] = value
+            else:
+                try:
+                    print_settings[key] = float(value)
+                except ValueError:
+                    raise ValueError("Can't read %s = %s in Cura profile %s" % (key, value, path))
+    # The defaults that depend on other settings, the same way Cura works them out
+    if print_settings["raft_base_thickness"] is None:
+        print_settings["raft_base_thickness"] = print_settings["layer_height_0"] * 1.2
+    if print_settings["raft_interface_thickness"] is None:
+        print_settings["raft_interface_thickness"] = print_settings["layer_height"] * 1.5
+    if print_settings["raft_surface_thickness"] is None:
+        print_settings["raft_surface_thickness"] = print_settings["layer_height"]
+    if print_settings["layer_0_z_overlap"] is None:
+        print_settings["layer_0_z_overlap"] = print_settings["raft_airgap"] / 2
+    PROFILE_CACHE[digest] = print_settings
+    return dict(print_settings)
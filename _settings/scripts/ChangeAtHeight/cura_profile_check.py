@@ -0,0 +1,131 @@
+# Checks that pause heights are turned into the right layers: readPrintSettings (cura_profile.py) on the profiles in _settings/settings and on made up raft profiles,
+# and LayerHeights.getLayerNumber on what comes out of them, against layer heights worked out by hand.
+# Without a raft, a pause at a height placed as a layer also has to give the same g-code as the same pause placed by the Z of the moves, on generated prints.
+#   python cura_profile_check.py
+# Exits with 1 and says what went wrong if any check fails.
+
+import argparse
+import os
+import sys
+import tempfile
+import zipfile
+
+from ChangeAtHeight import ChangeAtHeight
+from cura_profile import PRINT_KEYS, readPrintSettings
+from synthetic_gcode import generateGcode
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "settings")
+MACHINE_SETTINGS = {"machine_width": 200, "machine_depth": 200, "machine_height": 180}
+
+# Profile in the repository: settings it has to give
+PROFILE_SETTINGS = {
+    "normal_pla.curaprofile": {"layer_height": 0.16, "layer_height_0": 0.2, "adhesion_type": "skirt"},
+    "draft_pla.curaprofile": {"layer_height": 0.2, "layer_height_0": 0.2, "adhesion_type": "skirt"},
+    # It doesn't set the first layer, so that's Cura's default
+    "draft_petg.curaprofile": {"layer_height": 0.2, "layer_height_0": 0.3, "adhesion_type": "skirt"},
+}
+
+# The [values] of the made up raft profiles, global stack first, then the extruder. The extruder sets what the global one leaves to a formula
+RAFT_VALUES = (
+    {"layer_height": "0.2", "layer_height_0": "0.3", "adhesion_type": "raft", "raft_base_thickness": "0.36", "raft_interface_thickness": "= layer_height * 1.5",
+        "raft_surface_layers": "2", "raft_surface_thickness": "0.2", "raft_airgap": "0.3", "layer_0_z_overlap": "0.15"},
+    {"raft_interface_thickness": "0.3"},
+)
+# Interface layers: the Z of every layer of the raft, then of the first layers of the model (the first layer is 0.3 above the raft, plus the air gap, less the overlap)
+RAFT_LAYER_Z = {
+    1: (0.36, 0.66, 0.86, 1.06, 1.51, 1.71, 1.91),
+    0: (0.36, 0.56, 0.76, 1.21, 1.41),
+    None: (0.36, 0.66, 0.86, 1.06, 1.51, 1.71),
+}
+
+#   A .curaprofile like the ones Cura exports, with the given [values] for the global stack and the extruder
+def writeProfile(path, global_values, extruder_values):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, values in (("check_raft", global_values), ("check_extruder_0_#2_raft", extruder_values)):
+            lines = ["[general]", "version = 4", "name = Raft check", "definition = wanhao_i3", "", "[values]"]
+            lines += ["%s = %s" % (key, value) for key, value in values.items()]
+            archive.writestr(name, "\n".join(lines) + "\n")
+
+def getLayerHeights(print_settings):
+    script = ChangeAtHeight()
+    script.print_settings = print_settings
+    return script.getLayerHeights()
+
+#   Every layer has to be found at its own Z, and the layer above it just over it
+def checkLayerNumbers(name, layer_heights, layer_z, errors):
+    for layer, z in enumerate(layer_z, 1):
+        if abs(layer_heights.getLayerZ(layer) - z) > 1e-9:
+            errors.append("%s: layer %d is at Z %s, not %s" % (name, layer, layer_heights.getLayerZ(layer), z))
+        if layer_heights.getLayerNumber(z) != layer:
+            errors.append("%s: a pause at %s goes in layer %d, not %d" % (name, z, layer_heights.getLayerNumber(z), layer))
+        if layer_heights.getLayerNumber(z + 0.001) != layer + 1:
+            errors.append("%s: a pause at %s goes in layer %d, not %d" % (name, z + 0.001, layer_heights.getLayerNumber(z + 0.001), layer + 1))
+    if layer_heights.getLayerNumber(0) != 1:
+        errors.append("%s: a pause at 0 goes in layer %d, not 1" % (name, layer_heights.getLayerNumber(0)))
+
+def checkRepositoryProfiles(directory, errors):
+    for file_name, expected in sorted(PROFILE_SETTINGS.items()):
+        print_settings = readPrintSettings(os.path.join(directory, file_name))
+        if set(print_settings) != set(PRINT_KEYS):
+            errors.append("%s: has settings %s instead of %s" % (file_name, sorted(print_settings), sorted(PRINT_KEYS)))
+        for key, value in expected.items():
+            if print_settings.get(key) != value:
+                errors.append("%s: %s is %r, not %r" % (file_name, key, print_settings.get(key), value))
+        # Every layer after the first is one layer height higher, up to layers that are far enough for the rounding to add up
+        layer_z = [round(expected["layer_height_0"] + layer * expected["layer_height"], 3) for layer in range(1000)]
+        checkLayerNumbers(file_name, getLayerHeights(print_settings), layer_z, errors)
+
+def checkRaftProfiles(directory, errors):
+    for interface_layers, layer_z in RAFT_LAYER_Z.items():
+        global_values = dict(RAFT_VALUES[0])
+        if interface_layers is not None:
+            global_values["raft_interface_layers"] = str(interface_layers)
+        path = os.path.join(directory, "raft_%s.curaprofile" % interface_layers)
+        writeProfile(path, global_values, RAFT_VALUES[1])
+        print_settings = readPrintSettings(path)
+        name = "raft with %s interface layers" % ("the default" if interface_layers is None else interface_layers)
+        if print_settings["raft_interface_thickness"] != 0.3:
+            errors.append("%s: the interface thickness is %r, not the extruder's 0.3" % (name, print_settings["raft_interface_thickness"]))
+        checkLayerNumbers(name, getLayerHeights(print_settings), layer_z, errors)
+        # In Cura a setting can also come back as None, which has to be the default and not 0 layers
+        if interface_layers is None and getLayerHeights(dict(print_settings, raft_interface_layers = None)) != getLayerHeights(print_settings):
+            errors.append("%s: no number of interface layers isn't the default" % name)
+    # Adaptive layers are only known from the g-code
+    print_settings = dict(print_settings, adaptive_layer_height_enabled = True)
+    if getLayerHeights(print_settings) is not None:
+        errors.append("adaptive layers: got layer heights from the print settings")
+
+#   A pause at a height has to go in the same place whether it's placed as a layer or by the Z of the moves
+def checkPauses(errors):
+    for layer_height, first_layer_height in ((0.2, 0.3), (0.16, 0.2), (0.12, 0.2)):
+        data = generateGcode(layers = 60, lines_per_layer = 40, layer_height = layer_height, first_layer_height = first_layer_height, seed = 1)
+        print_settings = dict(PRINT_KEYS, layer_height = layer_height, layer_height_0 = first_layer_height, adhesion_type = "skirt")
+        for height in (0.1, first_layer_height, first_layer_height + 0.01, 2.0, 5.55, first_layer_height + 59 * layer_height):
+            outputs = []
+            for as_layer in (False, True):
+                script = ChangeAtHeight()
+                script.settings.update(pause_type = "height", pause_height = height, pause_height_as_layer = as_layer)
+                script.machine_settings = dict(MACHINE_SETTINGS)
+                script.print_settings = print_settings
+                outputs.append(script.execute(list(data)))
+            if outputs[0] != outputs[1]:
+                errors.append("a pause at %s with %s mm layers isn't placed the same as a layer" % (height, layer_height))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check how pause heights are turned into layers from Cura profiles.")
+    parser.add_argument("--directory", default = DEFAULT_DIRECTORY, help = "Where the *.curaprofile files are (default %(default)s).")
+    args = parser.parse_args(argv)
+    errors = []
+    checkRepositoryProfiles(args.directory, errors)
+    with tempfile.TemporaryDirectory() as directory:
+        checkRaftProfiles(directory, errors)
+    checkPauses(errors)
+    for error in errors:
+        print("cura_profile_check: %s" % error, file = sys.stderr)
+    if errors:
+        return 1
+    print("Cura profiles and layer numbers checked")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
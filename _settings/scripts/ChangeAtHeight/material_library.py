@@ -0,0 +1,208 @@
+# The Cura material profiles in _settings/materials (*.xml.fdm_material), indexed so the pauses can heat back up to the right temperature for a material.
+# The XML files are only parsed when they change: the index is kept in a JSON cache next to the layer cache, and checked against the modification time and size of every file.
+# A material can be looked up by its GUID, its file name without the extension (hatchbox_pla_true_red), its label, or brand, material and color together.
+# A name more than one profile has, like the GUID that profiles copied from each other share, can't be used to look one up.
+# Its settings can be overridden per machine (by product name) and per hotend on that machine, like Cura does:
+#   library = MaterialLibrary.load()
+#   library.getTemperature("hatchbox_pla_true_red", machine = "IMADE3D JellyBOX", hotend = "0.4 mm")
+#
+# As a command line tool it lists the materials and their temperatures:
+#   python material_library.py --machine cartesio
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import xml.etree.ElementTree as ElementTree
+
+# Where the material profiles are in this repository
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "materials")
+DEFAULT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ChangeAtHeight", "materials.json")
+EXTENSION = ".xml.fdm_material"
+NAMESPACE = {"m": "http://www.ultimaker.com/material"}
+# Change this when what parseMaterial keeps changes, so old caches are read again
+CACHE_VERSION = 1
+
+#   The key a name is looked up by: lower case, with anything that isn't a letter or digit as a single _
+def normalizeName(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip("_")
+
+#   The settings of a <settings>, <machine> or <hotend> element, without the ones of elements inside it. Numbers are floats
+def readSettings(element):
+    settings = {}
+    for setting in element.findall("m:setting", NAMESPACE):
+        value = (setting.text or "").strip()
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+        settings[setting.get("key")] = value
+    return settings
+
+#   Everything the index needs from one material file, as plain values so it can go in the cache
+def parseMaterial(path):
+    root = ElementTree.parse(path).getroot()
+    metadata = root.find("m:metadata", NAMESPACE)
+    name = metadata.find("m:name", NAMESPACE)
+    material = {
+        "guid": metadata.findtext("m:GUID", "", NAMESPACE).strip(),
+        "brand": name.findtext("m:brand", "", NAMESPACE).strip(),
+        "material": name.findtext("m:material", "", NAMESPACE).strip(),
+        "color": name.findtext("m:color", "", NAMESPACE).strip(),
+        "label": name.findtext("m:label", "", NAMESPACE).strip(),
+        "settings": {},
+        "machines": [],
+    }
+    settings = root.find("m:settings", NAMESPACE)
+    if settings is not None:
+        material["settings"] = readSettings(settings)
+        for machine in settings.findall("m:machine", NAMESPACE):
+            identifiers = [(identifier.get("manufacturer", ""), identifier.get("product", "")) for identifier in machine.findall("m:machine_identifier", NAMESPACE)]
+            hotends = {hotend.get("id"): readSettings(hotend) for hotend in machine.findall("m:hotend", NAMESPACE)}
+            material["machines"].append({"identifiers": identifiers, "settings": readSettings(machine), "hotends": hotends})
+    return material
+
+class Material:
+    def __init__(self, name, values):
+        # The file name without the extension
+        self.name = name
+        self.guid = values["guid"]
+        self.brand = values["brand"]
+        self.material = values["material"]
+        self.color = values["color"]
+        self.label = values["label"]
+        self.settings = values["settings"]
+        # The settings with the overrides already applied, by (product, hotend id), hotend None for the machine itself. Products are normalized with normalizeName
+        self.overrides = {}
+        for machine in values["machines"]:
+            machine_settings = dict(self.settings, **machine["settings"])
+            for manufacturer, product in machine["identifiers"]:
+                product = normalizeName(product)
+                self.overrides[(product, None)] = machine_settings
+                for hotend, hotend_settings in machine["hotends"].items():
+                    self.overrides[(product, hotend)] = dict(machine_settings, **hotend_settings)
+
+    #   The settings for a machine (product name) and hotend, falling back to the machine's and then the material's own ones
+    def getSettings(self, machine = None, hotend = None):
+        if machine is not None:
+            product = normalizeName(machine)
+            settings = self.overrides.get((product, hotend))
+            if settings is None:
+                settings = self.overrides.get((product, None))
+            if settings is not None:
+                return settings
+        return self.settings
+
+    #   The print temperature (standby = False) or standby temperature (standby = True), None if the profile doesn't have it
+    def getTemperature(self, machine = None, hotend = None, standby = False):
+        value = self.getSettings(machine, hotend).get("standby temperature" if standby else "print temperature")
+        return value if isinstance(value, float) else None
+
+class MaterialLibrary:
+    def __init__(self, materials):
+        self.materials = materials
+        # Every name a material can be looked up by, normalized, with the materials that have it.
+        # Profiles copied from another one can share its GUID, and the label of one can be the file name of another, so a name can have more than one
+        self.index = {}
+        for material in materials:
+            keys = {normalizeName(key) for key in (material.guid, material.name, material.label, " ".join((material.brand, material.material, material.color)))}
+            keys.discard("")
+            for key in keys:
+                self.index.setdefault(key, []).append(material)
+
+    #   Read the material profiles in directory, using and updating the cache at cache_path (None for no cache)
+    @classmethod
+    def load(cls, directory = DEFAULT_DIRECTORY, cache_path = DEFAULT_CACHE):
+        cache = {}
+        if cache_path is not None:
+            try:
+                with open(cache_path) as f:
+                    saved = json.load(f)
+                if saved.get("version") == CACHE_VERSION and saved.get("directory") == os.path.abspath(directory):
+                    cache = saved["files"]
+            except (OSError, ValueError, KeyError):
+                pass
+        files = {}
+        changed = False
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(EXTENSION):
+                continue
+            stat = os.stat(os.path.join(directory, file_name))
+            entry = cache.get(file_name)
+            if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                try:
+                    values = parseMaterial(os.path.join(directory, file_name))
+                except (ElementTree.ParseError, AttributeError) as e:
+                    raise ValueError("Can't read material profile %s: %s" % (file_name, e))
+                entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "material": values}
+                changed = True
+            files[file_name] = entry
+        if cache_path is not None and (changed or files.keys() != cache.keys()):
+            cls.saveCache(cache_path, {"version": CACHE_VERSION, "directory": os.path.abspath(directory), "files": files})
+        return cls([Material(file_name[:-len(EXTENSION)], entry["material"]) for file_name, entry in files.items()])
+
+    #   Write the cache next to where it goes and move it in place, so a run that's reading it at the same time never sees half of it
+    @staticmethod
+    def saveCache(cache_path, cache):
+        directory = os.path.dirname(cache_path)
+        try:
+            os.makedirs(directory, exist_ok = True)
+            handle, temp_path = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+            with os.fdopen(handle, "w") as f:
+                json.dump(cache, f)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # The cache only makes the next run quicker
+            pass
+
+    #   The material by any of its names, see normalizeName. Raises ValueError if there's no such material, or more than one has the name
+    def find(self, name):
+        materials = self.index.get(normalizeName(name))
+        if materials is None:
+            raise ValueError("Unknown material '%s'" % name)
+        if len(materials) > 1:
+            raise ValueError("Material '%s' could be any of %s, use a name only one of them has, like the file name" % (name, ", ".join(material.name for material in materials)))
+        return materials[0]
+
+    #   The temperature to heat back up to after a pause for the named material, see Material.getTemperature
+    def getTemperature(self, name, machine = None, hotend = None, standby = False):
+        temperature = self.find(name).getTemperature(machine, hotend, standby)
+        if temperature is None:
+            raise ValueError("Material '%s' has no %s temperature" % (name, "standby" if standby else "print"))
+        return temperature
+
+#   The materials for the machine and hotend the print is for, this is what ChangeAtHeight uses to look up material names in the pause schedule (its material_library).
+#   The library is only loaded when the first name is looked up, so runs that don't use it never read the profiles
+class MachineMaterials:
+    def __init__(self, machine = None, hotend = None, directory = DEFAULT_DIRECTORY, cache_path = DEFAULT_CACHE):
+        self.machine = machine
+        self.hotend = hotend
+        self.directory = directory
+        self.cache_path = cache_path
+        self.library = None
+
+    def getTemperature(self, name):
+        if self.library is None:
+            self.library = MaterialLibrary.load(self.directory, self.cache_path)
+        return self.library.getTemperature(name, self.machine, self.hotend)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "List the material profiles and their temperatures.")
+    parser.add_argument("--directory", default = DEFAULT_DIRECTORY, help = "Where the *%s files are (default %%(default)s)." % EXTENSION)
+    parser.add_argument("--cache", default = DEFAULT_CACHE, help = "The index cache (default %(default)s).")
+    parser.add_argument("--machine", help = "Show the temperatures for this machine (product name in the profiles).")
+    parser.add_argument("--hotend", help = "Show the temperatures for this hotend on the machine.")
+    args = parser.parse_args(argv)
+    try:
+        library = MaterialLibrary.load(args.directory, args.cache)
+    except (OSError, ValueError) as e:
+        print("material_library: %s" % e, file = sys.stderr)
+        return 1
+    for material in library.materials:
+        print("%-36s %-38s print %6s  standby %6s" % (material.name, material.guid, material.getTemperature(args.machine, args.hotend), material.getTemperature(args.machine, args.hotend, standby = True)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
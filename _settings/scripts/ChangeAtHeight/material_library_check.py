@@ -0,0 +1,97 @@
+# Checks how material_library.py looks up the material profiles in _settings/materials: every profile has to be found by its file name, its label and by brand,
+# material and color, with its own temperatures, and a name that more than one profile has (like the GUID most of them share) has to be refused, not give one of them.
+# The same goes for a pause schedule that heats back up to a material by name.
+#   python material_library_check.py
+# Exits with 1 and says what went wrong if any check fails.
+
+import argparse
+import sys
+
+from ChangeAtHeight import parsePauseSchedule
+from material_library import DEFAULT_DIRECTORY, Material, MaterialLibrary
+
+# The GUID the profiles copied from the same one share in the repository, and two of them with different temperatures
+SHARED_GUID = "0ff92885-617b-4144-a03c-9989872454bc"
+SHARING = ("3ds_pla_see_through_blue", "matterhackers_pla_pink")
+# Profile in the repository: its print and standby temperature
+TEMPERATURES = {
+    "3ds_pla_see_through_blue": (200, 175),
+    "matterhackers_pla_pink": (205, 175),
+    "3ds_petg_clear": (210, 120),
+}
+
+#   A material as material_library.parseMaterial gives it, without settings for machines
+def makeMaterial(name, guid, label, temperature):
+    return Material(name, {"guid": guid, "brand": "Check", "material": "PLA", "color": name, "label": label, "settings": {"print temperature": float(temperature)}, "machines": []})
+
+#   Looking up name has to be refused, with an error that names every one of the materials that have it. Returns what went wrong, or None
+def checkAmbiguous(library, name, material_names):
+    try:
+        material = library.find(name)
+    except ValueError as e:
+        missing = [material_name for material_name in material_names if material_name not in str(e)]
+        if missing:
+            return "'%s' is refused, but the error doesn't name %s: %s" % (name, ", ".join(missing), e)
+        return None
+    return "'%s' gives %s, but %s all have it" % (name, material.name, ", ".join(material_names))
+
+def checkRepositoryMaterials(directory, errors):
+    library = MaterialLibrary.load(directory, cache_path = None)
+    for material in library.materials:
+        for name in (material.name, material.label, " ".join((material.brand, material.material, material.color))):
+            try:
+                found = library.find(name)
+            except ValueError as e:
+                errors.append("%s: can't be found by '%s': %s" % (material.name, name, e))
+                continue
+            if found is not material:
+                errors.append("%s: '%s' gives %s" % (material.name, name, found.name))
+    for name, (temperature, standby) in sorted(TEMPERATURES.items()):
+        if library.getTemperature(name) != temperature or library.getTemperature(name, standby = True) != standby:
+            errors.append("%s: has temperatures %s and %s, not %s and %s" % (name, library.getTemperature(name), library.getTemperature(name, standby = True), temperature, standby))
+
+    sharing = [material.name for material in library.materials if material.guid == SHARED_GUID]
+    if not set(SHARING) <= set(sharing):
+        errors.append("the profiles sharing %s are %s, the check needs different ones" % (SHARED_GUID, ", ".join(sharing)))
+    error = checkAmbiguous(library, SHARED_GUID, sharing)
+    if error:
+        errors.append(error)
+    # A GUID only one profile has still finds it
+    petg = library.find("3ds_petg_clear")
+    if library.find(petg.guid.upper()) is not petg:
+        errors.append("3ds_petg_clear can't be found by its GUID")
+
+    try:
+        parsePauseSchedule("5@%s" % SHARED_GUID, "m25", library.getTemperature)
+        errors.append("a pause schedule heats back up to the shared GUID")
+    except ValueError:
+        pass
+    pauses = parsePauseSchedule("5@matterhackers_pla_pink, 9@MH Pink PLA", "m25", library.getTemperature)
+    if [pause.temperature for pause in pauses] != [205, 205]:
+        errors.append("a pause schedule heats back up to %s for matterhackers_pla_pink, not 205" % [pause.temperature for pause in pauses])
+
+#   The label of one profile that is the file name of another one
+def checkNameCollisions(errors):
+    library = MaterialLibrary([makeMaterial("check_red", "guid-red", "Check Blue", 200), makeMaterial("check_blue", "guid-blue", "Blue", 210)])
+    error = checkAmbiguous(library, "check_blue", ["check_red", "check_blue"])
+    if error:
+        errors.append(error)
+    if library.find("guid-red").name != "check_red" or library.getTemperature("Blue") != 210:
+        errors.append("names only one made up profile has don't find it")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check how material_library.py looks up the material profiles.")
+    parser.add_argument("--directory", default = DEFAULT_DIRECTORY, help = "Where the material profiles are (default %(default)s).")
+    args = parser.parse_args(argv)
+    errors = []
+    checkRepositoryMaterials(args.directory, errors)
+    checkNameCollisions(errors)
+    for error in errors:
+        print("material_library_check: %s" % error, file = sys.stderr)
+    if errors:
+        return 1
+    print("Material profiles checked")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
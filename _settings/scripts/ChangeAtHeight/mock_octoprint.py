@@ -0,0 +1,194 @@
+# A stand-in for the parts of OctoPrint's API that octoprint_upload.py uses, to try uploads without a printer.
+# It answers /api/version and takes uploads to /api/files/local (multipart, with a Content-Length or chunked), checking the X-Api-Key.
+# Uploads are kept in memory, and written to a directory too if one is given. bytes_per_second slows reading the uploads down, like a slow network would.
+#   python mock_octoprint.py --port 5000 --api-key test --directory uploads
+#   python octoprint_upload.py print.gcode --url http://127.0.0.1:5000 --api-key test --pause-layer 12 --machine-width 200 --machine-depth 200 --machine-height 180
+# It can also run inside a test, on a free port:
+#   server = MockOctoPrint("test")
+#   port = await server.start()
+
+import argparse
+import asyncio
+import json
+import os
+import posixpath
+import re
+import sys
+
+# How much of an upload is read at once when it's slowed down
+READ_SIZE = 64 * 1024
+
+class MockOctoPrint:
+    def __init__(self, api_key, directory = None, bytes_per_second = None):
+        self.api_key = api_key
+        self.directory = directory
+        self.bytes_per_second = bytes_per_second
+        # The uploaded files by name, and the form fields that came with them
+        self.files = {}
+        self.fields = {}
+        # Counters to check the client against: connections opened, requests answered and chunks of chunked uploads
+        self.connections = 0
+        self.requests = 0
+        self.chunks = 0
+        self.server = None
+        self.read_start = 0.
+
+    #   Start listening, returns the port (a free one when port is 0)
+    async def start(self, host = "127.0.0.1", port = 0):
+        self.server = await asyncio.start_server(self.handleConnection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handleConnection(self, reader, writer):
+        self.connections += 1
+        try:
+            # Keep answering requests on the connection until the client closes it
+            while await self.handleRequest(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    #   Answer one request. Returns False when the connection is done
+    async def handleRequest(self, reader, writer):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return False
+        method, path, version = request_line.decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await self.readBody(reader, headers)
+        self.requests += 1
+
+        if headers.get("x-api-key") != self.api_key:
+            status, answer = 403, {"error": "Invalid API key"}
+        elif method == "GET" and path == "/api/version":
+            status, answer = 200, {"api": "0.1", "server": "1.4.0", "text": "OctoPrint (mock)"}
+        elif method == "POST" and path == "/api/files/local":
+            status, answer = self.upload(headers, body)
+        else:
+            status, answer = 404, {"error": "Not found"}
+
+        data = json.dumps(answer).encode("utf-8")
+        keep_alive = headers.get("connection", "").lower() != "close"
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+            status, {200: "OK", 201: "Created", 400: "Bad Request", 403: "Forbidden", 404: "Not Found"}[status], len(data), "keep-alive" if keep_alive else "close")).encode("latin-1") + data)
+        await writer.drain()
+        return keep_alive
+
+    async def readBody(self, reader, headers):
+        body = bytearray()
+        # When reading of this body started, to keep it to bytes_per_second over all of it
+        self.read_start = asyncio.get_running_loop().time()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                await self.readInto(reader, body, size)
+                await reader.readline()
+                self.chunks += 1
+        else:
+            await self.readInto(reader, body, int(headers.get("content-length", 0)))
+        return bytes(body)
+
+    async def readInto(self, reader, body, size):
+        if self.bytes_per_second is None:
+            body += await reader.readexactly(size)
+            return
+        loop = asyncio.get_running_loop()
+        while size > 0:
+            part = await reader.readexactly(min(size, READ_SIZE))
+            body += part
+            size -= len(part)
+            # Wait until the body so far would have come in at that speed, so the time spent reading doesn't add up on top of it
+            delay = self.read_start + len(body) / self.bytes_per_second - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    #   The name an upload is stored under, from the file name and folder the client gave, None when it would end up outside of the storage.
+    #   They come from the client, so they can't be put in a path as they are
+    @staticmethod
+    def getStoragePath(name):
+        if "\\" in name or "\0" in name:
+            return None
+        name = posixpath.normpath(name)
+        if name.startswith("/") or name == "." or name == ".." or name.startswith("../"):
+            return None
+        return name
+
+    #   Take a multipart upload the way OctoPrint does: the file in the "file" field, the other fields as options
+    def upload(self, headers, body):
+        match = re.search(r'boundary="?([^";]+)"?', headers.get("content-type", ""))
+        if match is None:
+            return 400, {"error": "No multipart boundary"}
+        boundary = b"--" + match.group(1).encode("latin-1")
+        name = None
+        content = None
+        fields = {}
+        # Every part is between two boundaries, the last one is followed by --
+        for part in body.split(boundary)[1:-1]:
+            part_headers, _, value = part[2:-2].partition(b"\r\n\r\n")
+            disposition = re.search(rb'name="([^"]*)"(?:; filename="([^"]*)")?', part_headers)
+            if disposition is None:
+                return 400, {"error": "Part without a name"}
+            if disposition.group(1) == b"file":
+                name = disposition.group(2).decode("utf-8")
+                content = value
+            else:
+                fields[disposition.group(1).decode("utf-8")] = value.decode("utf-8")
+        if content is None:
+            return 400, {"error": "No file included"}
+        path = fields.get("path", "").strip("/")
+        name = self.getStoragePath(path + "/" + name if path else name)
+        if name is None:
+            return 400, {"error": "Bad file name"}
+        self.files[name] = content
+        self.fields[name] = fields
+        if self.directory is not None:
+            output_path = os.path.join(self.directory, *name.split("/"))
+            directory = os.path.realpath(self.directory)
+            if os.path.commonpath([directory, os.path.realpath(output_path)]) != directory:
+                return 400, {"error": "Bad file name"}
+            os.makedirs(os.path.dirname(output_path), exist_ok = True)
+            with open(output_path, "wb") as f:
+                f.write(content)
+        return 201, {
+            "done": True,
+            "files": {"local": {"name": os.path.basename(name), "path": name, "origin": "local", "refs": {
+                "resource": "/api/files/local/" + name, "download": "/downloads/files/local/" + name}}},
+        }
+
+async def serve(host, port, api_key, directory, bytes_per_second):
+    server = MockOctoPrint(api_key, directory, bytes_per_second)
+    port = await server.start(host, port)
+    print("Mock OctoPrint on http://%s:%d, API key %s" % (host, port, api_key))
+    async with server.server:
+        await server.server.serve_forever()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "A stand-in for OctoPrint's upload API, to try octoprint_upload.py without a printer.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 5000)
+    parser.add_argument("--api-key", default = "test")
+    parser.add_argument("--directory", help = "Write the uploaded files here as well.")
+    parser.add_argument("--bytes-per-second", type = float, help = "Read uploads no faster than this, like a slow network.")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.api_key, args.directory, args.bytes_per_second))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+# Adds the pauses to sliced g-code files and uploads them to OctoPrint in one go, without writing the result to disk or holding all of it in memory.
+# The script runs in a worker thread and hands its output over in chunks. The chunks go straight into a multipart upload that is sent with chunked transfer encoding,
+# so the file is being sent while the rest of it is still being made. Only a few chunks are ever waiting (see --queue-chunks): when the network is slower than the script,
+# the script waits for the upload, and when it's faster, the upload waits for the script.
+# All of the files of one run go over the same connection.
+#   python octoprint_upload.py print.gcode --url http://octopi.local --api-key KEY --pause-layer 12 --machine-profile wanhao_i3_settings.inst.cfg
+# The API key can also come from OCTOPRINT_API_KEY, and the address from OCTOPRINT_URL. To try it without a printer, run mock_octoprint.py and upload to that, octoprint_upload_check.py does that as a check.
+# Only the Python standard library is used.
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import ssl
+import sys
+import time
+import urllib.parse
+import uuid
+
+from ChangeAtHeight import ChangeAtHeight
+from change_at_height_cli import addMachineArguments, addSettingArguments, configureScript, processMappedFile
+
+# Bytes of g-code per chunk of the upload
+CHUNK_SIZE = 1024 * 1024
+# Chunks that can be made ahead of the upload before the script waits for it
+QUEUE_CHUNKS = 4
+# Seconds to wait for OctoPrint to answer once a request has been sent
+RESPONSE_TIMEOUT = 120
+
+#   Yield the output of the script for a g-code file as chunks of bytes of about chunk_size.
+#   Runs in the worker thread, one chunk per call of next(), so the layers are only made as fast as the upload takes them.
+def processInChunks(script, path, chunk_size):
+    chunk = bytearray()
+    for layer in processMappedFile(script, path):
+        if isinstance(layer, str):
+            chunk += layer.encode("utf-8", "surrogateescape")
+        else:
+            # Memoryviews of the mapped file have to be copied out before it's closed
+            with layer:
+                chunk += layer
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+#   An async iterator over the chunks of processInChunks. The chunks are made in a thread of its own, up to queue_chunks ahead of whoever reads them
+async def processedChunks(script, path, chunk_size = CHUNK_SIZE, queue_chunks = QUEUE_CHUNKS):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize = queue_chunks)
+    chunks = processInChunks(script, path, chunk_size)
+    # The end of the chunks, or the error that stopped them
+    done = object()
+
+    async def produce():
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, chunks, done)
+                await queue.put(chunk)
+                if chunk is done:
+                    return
+        except Exception as e:
+            await queue.put(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is done:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+            # Closes the mapped file. The worker thread is done with the generator by now, so it can be closed from here
+            await loop.run_in_executor(executor, chunks.close)
+
+# One connection to OctoPrint, kept open for all requests (HTTP/1.1 keep-alive) and opened again when the server closed it
+class OctoPrintClient:
+    def __init__(self, url, api_key):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("Can't use OctoPrint address '%s', give one like http://octopi.local" % url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        # OctoPrint can be behind a reverse proxy, under a path
+        self.base_path = parts.path.rstrip("/")
+        self.api_key = api_key
+        self.reader = None
+        self.writer = None
+        # How many times a connection was opened, to see the connection is reused
+        self.connections = 0
+
+    async def connect(self):
+        if self.writer is not None and not self.writer.is_closing() and not self.reader.at_eof():
+            return
+        await self.close()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl = self.ssl)
+        self.connections += 1
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    #   Send a request and return (status, headers, body). body is bytes, or an async iterator of bytes that is sent with chunked transfer encoding as it comes in.
+    #   Waiting for the network to take each chunk (drain) is what holds the script back when the upload is the slow part.
+    async def request(self, method, path, headers = None, body = None):
+        await self.connect()
+        try:
+            lines = ["%s %s HTTP/1.1" % (method, self.base_path + path), "Host: %s:%d" % (self.host, self.port), "X-Api-Key: %s" % self.api_key, "Connection: keep-alive"]
+            for name, value in (headers or {}).items():
+                lines.append("%s: %s" % (name, value))
+            if body is None or isinstance(body, bytes):
+                lines.append("Content-Length: %d" % len(body or b""))
+                self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+            else:
+                lines.append("Transfer-Encoding: chunked")
+                self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                async for chunk in body:
+                    if chunk:
+                        self.writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+                        await self.writer.drain()
+                self.writer.write(b"0\r\n\r\n")
+            await self.writer.drain()
+            return await asyncio.wait_for(self.readResponse(), RESPONSE_TIMEOUT)
+        except BaseException:
+            # The connection is in an unknown state, don't use it again
+            await self.close()
+            raise
+
+    async def readResponse(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("OctoPrint closed the connection without answering")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ConnectionError("Can't read OctoPrint's answer '%s'" % status_line.decode("latin-1").strip())
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                body += await self.reader.readexactly(size)
+                await self.reader.readline()
+            body = bytes(body)
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            # The answer ends where the connection does
+            body = await self.reader.read()
+            headers["connection"] = "close"
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, headers, body
+
+    #   OctoPrint's version information, as a check that the address and API key work
+    async def getVersion(self):
+        status, headers, body = await self.request("GET", "/api/version")
+        if status != 200:
+            raise ValueError("OctoPrint answered %d to /api/version: %s" % (status, body.decode("utf-8", "replace").strip()))
+        return json.loads(body)
+
+    #   Upload a file to OctoPrint's local storage, from an async iterator of its chunks.
+    #   folder is where to put it on OctoPrint, select and print do what they do in OctoPrint's upload API. Returns OctoPrint's answer
+    async def uploadFile(self, name, chunks, folder = None, select = False, print_after = False):
+        boundary = "----ChangeAtHeight" + uuid.uuid4().hex
+        fields = {"select": "true" if select else "false", "print": "true" if print_after else "false"}
+        if folder:
+            fields["path"] = folder
+
+        async def multipart():
+            yield ("--%s\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\nContent-Type: application/octet-stream\r\n\r\n" % (boundary, name.replace("\"", "_"))).encode("utf-8")
+            async for chunk in chunks:
+                yield chunk
+            ending = []
+            for field, value in fields.items():
+                ending.append("\r\n--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s" % (boundary, field, value))
+            ending.append("\r\n--%s--\r\n" % boundary)
+            yield "".join(ending).encode("utf-8")
+
+        status, headers, body = await self.request("POST", "/api/files/local", {"Content-Type": "multipart/form-data; boundary=%s" % boundary}, multipart())
+        if status != 201:
+            raise ValueError("OctoPrint didn't take %s, it answered %d: %s" % (name, status, body.decode("utf-8", "replace").strip()))
+        return json.loads(body)
+
+#   Run the script over every input file and upload the results one after the other over the same connection.
+#   Returns the number of files that failed, every other file is still uploaded
+async def uploadFiles(script, client, paths, folder = None, select = False, print_after = False, chunk_size = CHUNK_SIZE, queue_chunks = QUEUE_CHUNKS):
+    failed = 0
+    async with client:
+        await client.getVersion()
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                await client.uploadFile(os.path.basename(path), processedChunks(script, path, chunk_size, queue_chunks), folder, select, print_after)
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                # IncompleteReadError is when OctoPrint closed the connection in the middle of its answer
+                print("octoprint_upload: %s: %s" % (path, e), file = sys.stderr)
+                failed += 1
+                continue
+            seconds = time.perf_counter() - start
+            size = os.path.getsize(path) / 1e6
+            print("%8.2fs %8.1f MB/s  %s" % (seconds, size / seconds if seconds > 0 else 0, path))
+    return failed
+
+def main(argv = None):
+    script = ChangeAtHeight()
+    parser = argparse.ArgumentParser(description = "Change filament or pause at a given height in sliced g-code files, and upload them to OctoPrint while they are being made.")
+    parser.add_argument("input", nargs = "+", help = "The g-code files to add pauses to and upload. The originals aren't changed.")
+    parser.add_argument("--url", default = os.environ.get("OCTOPRINT_URL"), help = "Address of OctoPrint, eg. http://octopi.local (default $OCTOPRINT_URL).")
+    parser.add_argument("--api-key", default = os.environ.get("OCTOPRINT_API_KEY"), help = "OctoPrint API key (default $OCTOPRINT_API_KEY).")
+    parser.add_argument("--folder", help = "Folder to upload to on OctoPrint.")
+    parser.add_argument("--select", action = "store_true", help = "Select the file for printing once it's uploaded.")
+    parser.add_argument("--print", dest = "print_after", action = "store_true", help = "Start printing the file once it's uploaded. Only one file can be given.")
+    parser.add_argument("--chunk-size", type = int, default = CHUNK_SIZE, help = "Bytes per chunk of the upload (default %(default)s).")
+    parser.add_argument("--queue-chunks", type = int, default = QUEUE_CHUNKS, help = "Chunks that can be made ahead of the upload (default %(default)s).")
+    addMachineArguments(parser)
+    addSettingArguments(parser, script)
+    args = parser.parse_args(argv)
+    if not args.url or not args.api_key:
+        parser.error("the OctoPrint address and API key are needed, give --url and --api-key")
+    if args.print_after and len(args.input) > 1:
+        parser.error("--print can only be used with one file")
+    if args.chunk_size < 1 or args.queue_chunks < 1:
+        parser.error("--chunk-size and --queue-chunks must be at least 1")
+    configureScript(parser, args, script)
+
+    try:
+        client = OctoPrintClient(args.url, args.api_key)
+        failed = asyncio.run(uploadFiles(script, client, args.input, args.folder, args.select, args.print_after, args.chunk_size, args.queue_chunks))
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        print("octoprint_upload: %s" % e, file = sys.stderr)
+        return 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+# Checks octoprint_upload.py against mock_octoprint.py, without a printer or a network: generated prints are uploaded to the mock on a free local port,
+# and what it got has to be exactly what change_at_height_cli.py writes for the same files.
+# It also checks that all files of a run go over one connection, that a wrong API key is refused, and that the mock doesn't write outside of its directory.
+#   python octoprint_upload_check.py --layers 200 --chunk-size 65536
+# Exits with 1 and says what went wrong if any check fails.
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from ChangeAtHeight import ChangeAtHeight
+from change_at_height_cli import processMappedFile, writeLayers
+from mock_octoprint import MockOctoPrint
+from octoprint_upload import OctoPrintClient, uploadFiles
+from synthetic_gcode import writeGcode
+
+MACHINE_SETTINGS = {"machine_width": 200, "machine_depth": 200, "machine_height": 180}
+API_KEY = "check"
+FOLDER = "checks"
+
+def makeScript(pause_layer):
+    script = ChangeAtHeight()
+    script.settings["pause_layer"] = pause_layer
+    script.machine_settings = dict(MACHINE_SETTINGS)
+    return script
+
+#   The prints to upload: one with a single print sequence, and one printed One at a Time
+def makePrints(directory, layers):
+    paths = []
+    for name, sequences in (("single.gcode", 1), ("one_at_a_time.gcode", 3)):
+        path = os.path.join(directory, name)
+        writeGcode(path, layers = layers, lines_per_layer = 200, sequences = sequences, seed = sequences)
+        paths.append(path)
+    return paths
+
+#   What the command line tool makes of a file, as bytes
+def getExpected(script, path, directory):
+    output_path = os.path.join(directory, "expected_" + os.path.basename(path))
+    writeLayers(processMappedFile(script, path), output_path)
+    with open(output_path, "rb") as f:
+        return f.read()
+
+async def runChecks(paths, directory, pause_layer, chunk_size):
+    errors = []
+    server = MockOctoPrint(API_KEY, os.path.join(directory, "uploads"))
+    port = await server.start()
+    url = "http://127.0.0.1:%d" % port
+    try:
+        client = OctoPrintClient(url, API_KEY)
+        failed = await uploadFiles(makeScript(pause_layer), client, paths, FOLDER, select = True, chunk_size = chunk_size, queue_chunks = 2)
+        if failed:
+            errors.append("%d of the uploads failed" % failed)
+        if client.connections != 1 or server.connections != 1:
+            errors.append("the files went over %d connections (the mock saw %d), not one" % (client.connections, server.connections))
+        for path in paths:
+            name = FOLDER + "/" + os.path.basename(path)
+            expected = getExpected(makeScript(pause_layer), path, directory)
+            if server.files.get(name) != expected:
+                errors.append("%s didn't arrive the same as change_at_height_cli.py writes it" % name)
+                continue
+            with open(os.path.join(directory, "uploads", FOLDER, os.path.basename(path)), "rb") as f:
+                if f.read() != expected:
+                    errors.append("%s wasn't written out the same as it arrived" % name)
+            if server.fields[name].get("select") != "true":
+                errors.append("%s wasn't uploaded with select" % name)
+        if server.chunks <= len(paths):
+            errors.append("the uploads weren't sent in chunks")
+
+        try:
+            await uploadFiles(makeScript(pause_layer), OctoPrintClient(url, "wrong"), paths[:1])
+            errors.append("a wrong API key wasn't refused")
+        except ValueError as e:
+            if "403" not in str(e):
+                errors.append("a wrong API key wasn't refused with a 403: %s" % e)
+
+        async with OctoPrintClient(url, API_KEY) as client:
+            for name in ("../outside.gcode", "/tmp/outside.gcode"):
+                try:
+                    await client.uploadFile(name, chunksOf(b";LAYER:0\n"))
+                    errors.append("the mock took an upload named %s" % name)
+                except ValueError:
+                    pass
+        if os.path.exists(os.path.join(directory, "outside.gcode")):
+            errors.append("the mock wrote outside of its directory")
+    finally:
+        await server.stop()
+    return errors
+
+async def chunksOf(data):
+    yield data
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check octoprint_upload.py against the mock OctoPrint, on generated prints.")
+    parser.add_argument("--layers", type = int, default = 100, help = "Layers per generated print (default %(default)s).")
+    parser.add_argument("--pause-layer", type = int, default = 5, help = "Layer to pause at (default %(default)s).")
+    parser.add_argument("--chunk-size", type = int, default = 64 * 1024, help = "Bytes per chunk of the uploads (default %(default)s).")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = makePrints(directory, args.layers)
+        errors = asyncio.run(runChecks(paths, directory, args.pause_layer, args.chunk_size))
+    for error in errors:
+        print("octoprint_upload_check: %s" % error, file = sys.stderr)
+    if errors:
+        return 1
+    print("%d files uploaded and checked" % len(paths))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# Runs several post processing scripts over the g-code in one pass, instead of one pass per script.
+# Run one after the other, every script splits every layer into lines, goes through them and joins the layer again. In a chain, a layer is split once,
+# every line is tokenized at most once, and all the changes the scripts make to it are collected in one PieceTable and put in with a single join.
+#
+# Scripts take part by having one of these:
+# - visitLayer(layer): called with every ParsedLayer. The script reads layer.text, layer.lines or layer.getCommand(line_index) as it needs,
+#   and records its changes in layer.edits. ChangeAtHeight works this way, so layers without a pause are never split.
+# - visitLine(layer, line_index, command): called for every line, see LineVisitor.
+# Both can also have startChain() and finishChain(), called before the first layer and after the last one. finishChain() can return text to add to the end of the last layer,
+# like ChangeAtHeight's performance report, the same as a script's execute() can add it to data[-1].
+# Every script sees the layer as it came in, not with the changes of the scripts before it, so the scripts in a chain shouldn't depend on each other's changes.
+# Changes before the same line go in in the order of the scripts, visitLayer scripts before visitLine scripts, and so do the endings scripts add after the last line.
+#
+# Scripts that only have execute(data), like most PostProcessingPlugin scripts, still work in a chain: they split it into stages that run one after the other.
+#   chain = PostProcessingChain([change_at_height, other_script])
+#   data = chain.execute(data)
+# This is a library only: Cura's post processing plugin and the command line tools run every script on its own, and only change_at_height_equivalence.py runs a chain.
+
+import operator
+
+from ChangeAtHeight import spliceLines, tokenizeLine
+
+# The changes the scripts of a chain make to one layer, by line number of the layer as it came in
+class PieceTable:
+    __slots__ = ("insertions", "replacements", "endings")
+
+    def __init__(self):
+        # (line index, gcode) to put in front of that line, in the order they were made
+        self.insertions = []
+        # Line index: the text to replace that line with, or None to remove it
+        self.replacements = {}
+        # Text to put after the last line, like the newline a script adds when it makes the layer again
+        self.endings = []
+
+    def insertBefore(self, line_index, gcode):
+        self.insertions.append((line_index, gcode))
+
+    def replaceLine(self, line_index, text):
+        self.replacements[line_index] = text
+
+    def deleteLine(self, line_index):
+        self.replacements[line_index] = None
+
+    def addEnding(self, text):
+        self.endings.append(text)
+
+    def isEmpty(self):
+        return not self.insertions and not self.replacements and not self.endings
+
+    #   The layer with all of the changes in it. Insertions go in the same way as spliceLines puts them in
+    def apply(self, lines):
+        # Sorting is stable, so changes before the same line stay in order
+        insertions = sorted(self.insertions, key = operator.itemgetter(0))
+        if self.replacements:
+            # Where every line of the original layer ends up, to move the insertions along with the lines
+            new_lines = []
+            new_indices = []
+            for line_index, line in enumerate(lines):
+                new_indices.append(len(new_lines))
+                line = self.replacements.get(line_index, line)
+                if line is not None:
+                    new_lines.append(line)
+            new_indices.append(len(new_lines))
+            insertions = [(new_indices[line_index], gcode) for line_index, gcode in insertions]
+            lines = new_lines
+        ending = "".join(self.endings)
+        if insertions:
+            return spliceLines(lines, insertions, ending)
+        return "\n".join(lines) + ending
+
+# One layer of g-code as the scripts of a chain see it. It's only split into lines, and the lines only tokenized, when a script asks for them, and then only once.
+class ParsedLayer:
+    __slots__ = ("index", "text", "data", "edits", "_lines", "_commands")
+
+    def __init__(self, index, text, data = None):
+        # Where the layer is in the data list
+        self.index = index
+        self.text = text
+        # The data list, when the chain runs over one. Scripts can keep earlier layers around then without holding on to more of the file than is in memory already
+        self.data = data
+        self.edits = PieceTable()
+        self._lines = None
+        self._commands = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.text.split("\n")
+        return self._lines
+
+    #   The tokenized line, see tokenizeLine
+    def getCommand(self, line_index):
+        if self._commands is None:
+            self._commands = [None] * len(self.lines)
+        command = self._commands[line_index]
+        if command is None:
+            command = self._commands[line_index] = tokenizeLine(self._lines[line_index])
+        return command
+
+    #   The layer with the changes of all scripts in it
+    def getText(self):
+        if self.edits.isEmpty():
+            return self.text
+        return self.edits.apply(self.lines)
+
+# Base for scripts that look at every line. All of them go through the lines of a layer together, and get the same tokenized command for every line.
+class LineVisitor:
+    def startChain(self):
+        pass
+
+    #   Return False to skip the lines of this layer, which saves splitting and tokenizing it if no other script needs them either
+    def wantsLayer(self, layer):
+        return True
+
+    def visitLine(self, layer, line_index, command):
+        pass
+
+    def finishChain(self):
+        pass
+
+class PostProcessingChain:
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+
+    #   Can the script run in the shared pass, or does it need its own execute()?
+    @staticmethod
+    def isFusable(script):
+        return hasattr(script, "visitLayer") or hasattr(script, "visitLine")
+
+    #   Run all of the scripts over the layers in one pass, yielding every layer once all scripts are done with it. Every script has to be fusable.
+    #   The last layer is held back until the scripts are finished, for what their finishChain() adds to it.
+    def processLayers(self, layers):
+        for script in self.scripts:
+            if not self.isFusable(script):
+                raise ValueError("%s can't be part of a single pass, it has no visitLayer or visitLine" % type(script).__name__)
+        layer_visitors = [script for script in self.scripts if hasattr(script, "visitLayer")]
+        line_visitors = [script for script in self.scripts if not hasattr(script, "visitLayer")]
+        for script in self.scripts:
+            if hasattr(script, "startChain"):
+                script.startChain()
+        data = layers if isinstance(layers, list) else None
+        last_text = None
+        finished = False
+        try:
+            for index, text in enumerate(layers):
+                layer = ParsedLayer(index, text, data)
+                for script in layer_visitors:
+                    script.visitLayer(layer)
+                visitors = [script for script in line_visitors if script.wantsLayer(layer)]
+                if visitors:
+                    get_command = layer.getCommand
+                    for line_index in range(len(layer.lines)):
+                        command = get_command(line_index)
+                        for visitor in visitors:
+                            visitor.visitLine(layer, line_index, command)
+                if last_text is not None:
+                    yield last_text
+                last_text = layer.getText()
+            finished = True
+            endings = self.finishScripts()
+        finally:
+            if not finished:
+                self.finishScripts()
+        if last_text is not None:
+            yield last_text + "".join(endings)
+
+    #   Call finishChain() of every script that has one, returning the text they add to the last layer
+    def finishScripts(self):
+        endings = []
+        for script in self.scripts:
+            if hasattr(script, "finishChain"):
+                ending = script.finishChain()
+                if ending:
+                    endings.append(ending)
+        return endings
+
+    #   Same as running every script's execute() in turn. Fusable scripts next to each other share one pass
+    def execute(self, data):
+        stage = []
+        for script in self.scripts + [None]:
+            if script is not None and self.isFusable(script):
+                stage.append(script)
+                continue
+            if stage:
+                data[:] = PostProcessingChain(stage).processLayers(data)
+                stage = []
+            if script is not None:
+                data = script.execute(data)
+        return data
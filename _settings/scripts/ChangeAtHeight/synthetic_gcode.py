@@ -0,0 +1,121 @@
+# Generates g-code that looks like what Cura hands to post processing scripts: a list with the header, the start g-code, every layer and the end g-code.
+# Used to benchmark and check the ChangeAtHeight script without needing real prints, see change_at_height_benchmark.py.
+
+import random
+
+# The feature types Cura marks each part of a layer with
+FEATURE_TYPES = ("WALL-OUTER", "WALL-INNER", "SKIN", "FILL", "SUPPORT")
+
+HEADER = """;FLAVOR:Marlin
+;TIME:6666
+;Filament used: 10m
+;Layer height: 0.2
+;MINX:10
+;MINY:10
+;MINZ:0.3
+;MAXX:190
+;MAXY:190
+;MAXZ:100
+;Generated with Cura_SteamEngine 4.4.1
+"""
+
+START_GCODE = """M140 S60
+M105
+M190 S60
+M104 S200
+M105
+M109 S200
+M82 ;absolute extrusion mode
+G21 ;metric values
+G90 ;absolute positioning
+M82 ;set extruder to absolute mode
+M107 ;start with the fan off
+G28 X0 Y0 ;move X/Y to min endstops
+G28 Z0 ;move Z to min endstops
+G1 Z15.0 F9000 ;move the platform down 15mm
+G92 E0 ;zero the extruded length
+G1 F200 E6 ;extrude 6 mm of feed stock
+G92 E0 ;zero the extruded length again
+G1 F9000
+;Put printing message on LCD screen
+M117 Printing...
+"""
+
+END_GCODE = """;TIME_ELAPSED:6666.000000
+G1 F2400 E-5
+M140 S0
+M104 S0 ;extruder heater off
+G91 ;relative positioning
+G1 E-1 F300  ;retract the filament a bit before lifting the nozzle, to release some of the pressure
+G1 Z+0.5 E-5 X-20 Y-20 F9000 ;move Z up a bit and retract filament even more
+G28 X0 Y0 ;move X/Y to min endstops, so the head is out of the way
+M84 ;steppers off
+G90 ;absolute positioning
+M82 ;absolute extrusion mode
+M104 S0
+;End of Gcode
+"""
+
+#   Generate a print as a list of strings, the way Cura passes it to execute().
+#   layers: number of layers in each print sequence
+#   lines_per_layer: roughly how many moves each layer has
+#   sequences: number of print sequences. More than one is a One at a Time print, every sequence starts with its own ;LAYER_COUNT:
+#   relative_extrusion: use M83 and relative E values instead of absolute ones
+#   custom_every: put a ;TYPE:CUSTOM block in every n-th layer (0 for none), the way other post processing scripts add their g-code
+#   g92_every: reset the extruder with G92 E0 every n layers (0 for never)
+#   layer_height / first_layer_height: the Z steps between layers
+#   seed: the same seed always gives the same print
+def generateGcode(layers = 100, lines_per_layer = 500, sequences = 1, relative_extrusion = False, custom_every = 0, g92_every = 0, layer_height = 0.2, first_layer_height = 0.3, seed = 0):
+    rnd = random.Random(seed)
+    data = [HEADER]
+    for sequence in range(sequences):
+        e = 0.
+        start = START_GCODE if sequence == 0 else "G1 Z%.3f F9000 ;move up to the next object\nG92 E0\n" % (first_layer_height + layers * layer_height + 5)
+        if relative_extrusion:
+            start += "M83 ;relative extrusion mode\n"
+        data.append(start + ";LAYER_COUNT:%d\n" % layers)
+        # Every object of a One at a Time print is in its own place on the bed
+        offset = sequence * 40 % 120
+        for layer in range(layers):
+            z = first_layer_height + layer * layer_height
+            lines = [";LAYER:%d" % layer]
+            if layer == 1:
+                lines.append("M106 S255")
+            lines.append("G0 F9000 X%.3f Y%.3f Z%.3f" % (offset + rnd.uniform(10, 60), offset + rnd.uniform(10, 60), z))
+            if custom_every and layer % custom_every == custom_every - 1:
+                # Custom blocks are skipped by the script, whatever is in them
+                lines += [";TYPE:CUSTOM", ";added code by post processing", "G1 X5 Y5 Z%.3f E9999" % (z + 10), "M104 S250", ";CUSTOM block done"]
+            feature = None
+            for move in range(lines_per_layer):
+                if feature is None or rnd.random() < 0.02:
+                    feature = rnd.choice(FEATURE_TYPES)
+                    lines.append(";TYPE:%s" % feature)
+                r = rnd.random()
+                x = offset + rnd.uniform(10, 60)
+                y = offset + rnd.uniform(10, 60)
+                if r < 0.05:
+                    # Retract, travel and prime again
+                    if relative_extrusion:
+                        lines.append("G1 F2400 E-5")
+                    else:
+                        lines.append("G1 F2400 E%.5f" % (e - 5))
+                    lines.append("G0 F9000 X%.3f Y%.3f" % (x, y))
+                    lines.append("G1 F2400 E%.5f" % (5 if relative_extrusion else e))
+                elif r < 0.1:
+                    lines.append("G0 F9000 X%.3f Y%.3f" % (x, y))
+                else:
+                    extruded = rnd.uniform(0.01, 0.5)
+                    e += extruded
+                    lines.append("G1 X%.3f Y%.3f E%.5f" % (x, y, extruded if relative_extrusion else e))
+            if g92_every and layer % g92_every == g92_every - 1:
+                lines.append("G92 E0")
+                e = 0.
+            data.append("\n".join(lines) + "\n")
+    data.append(END_GCODE)
+    return data
+
+#   Generate a print and write it to a file, for the command line tools
+def writeGcode(path, **options):
+    with open(path, "w") as f:
+        for layer in generateGcode(**options):
+            f.write(layer)